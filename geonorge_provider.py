@@ -1,13 +1,20 @@
+import concurrent.futures
 import enum
 import hashlib
 import os
-import sys
+import random
+import threading
 import time
 import urllib
+import urllib.error
+from contextlib import contextmanager
+from functools import lru_cache
 from typing import (
+    Dict,
     List,
     NamedTuple,
     Optional,
+    Set,
     Tuple
 )
 
@@ -17,17 +24,179 @@ import wand
 from wand.exceptions import OptionError
 from wand.image import Image
 
+from httppool import defaultConnectionPool
 from nslock import NamespaceLock, getListOfActiveLocks
 from providers import (
     BaseDownloadProvider,
     BaseTileServerConfig,
     BaseTileSetConfig,
+    ImageFileType,
+    TileBlob,
+    TileDownloadError,
     bcolors,
-    buildCompositeImage,
-    printColor
+    buildCompositeFromLayers,
+    encodeImageForCache,
+    getImageFormatFromBlob,
+    getTileETag,
+    printColor,
+    printVerbose,
+    saveBlobAtomically,
+    saveImageAtomically
 )
+from tilecache import LRUBlobCache, markCacheFileUsed
 
 default_CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS = 1
+default_CONCURRENT_GEONORGE_WMS_REQUESTS = 1
+
+default_GEONORGE_WMS_MIN_REQUEST_INTERVAL_SEC = 0.2
+
+
+class _RateLimiter:
+    """
+    Spaces out the start of consecutive requests by at least
+    minIntervalSec. Each caller reserves the next free slot under the
+    lock, and sleeps until its slot without holding the lock.
+    """
+
+    def __init__(self, minIntervalSec: float):
+        self._minIntervalSec = minIntervalSec
+        self._lock = threading.Lock()
+        self._nextSlot = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._nextSlot)
+            self._nextSlot = slot + self._minIntervalSec
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class _LargeTileAdmission:
+    """
+    Limits the number of large tiles that are downloaded and processed
+    simultaneously. When a slot becomes free, it is handed to the waiting
+    large lock namespace with the most requests queued on it (highest
+    refcount), as that one will serve the most tiles. The winner is picked
+    once by the thread that releases the slot, so the waiters never have
+    to agree on a ranking that changes while they sleep.
+    """
+
+    def __init__(self, maxActive: int):
+        self._maxActive = maxActive
+        self._cond = threading.Condition()
+        # The number of slots in use, including the ones that have been
+        # granted to waiters that haven't woken up yet
+        self._active = 0
+        self._waiting: Set[str] = set()
+        self._granted: Set[str] = set()
+
+    def _grantFreeSlots(self):
+        # Must be called with the condition held
+        freeSlots = self._maxActive - self._active
+        if freeSlots <= 0 or not self._waiting:
+            return
+        if len(self._waiting) <= freeSlots:
+            winners = list(self._waiting)
+        else:
+            refcounts = getListOfActiveLocks()
+            winners = sorted(
+                self._waiting,
+                key=lambda waitingNs: (-refcounts.get(waitingNs, 0), waitingNs))[:freeSlots]
+        for ns in winners:
+            self._waiting.discard(ns)
+            self._granted.add(ns)
+            self._active += 1
+        self._cond.notify_all()
+
+    def _release(self):
+        # Must be called with the condition held
+        self._active -= 1
+        self._grantFreeSlots()
+
+    @contextmanager
+    def admit(self, ns: str):
+        with self._cond:
+            # Slots are handed to the waiters as soon as they are
+            # released, so a free slot means that nobody is waiting
+            if self._active < self._maxActive:
+                self._active += 1
+            else:
+                self._waiting.add(ns)
+                try:
+                    self._cond.wait_for(lambda: ns in self._granted)
+                except BaseException:
+                    self._waiting.discard(ns)
+                    if ns in self._granted:
+                        # Pass on the slot we were granted
+                        self._granted.discard(ns)
+                        self._release()
+                    raise
+                self._granted.discard(ns)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._release()
+
+
+# Do not process more than one large lock (downloading of massive tiles)
+# simultaneously by default - we risk running out of memory and geonorge
+# is terribly slow any way.
+_largeTileAdmission = _LargeTileAdmission(
+    int(os.environ.get(
+        "CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS",
+        default_CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS)))
+
+# Only the requests towards the WMS server are throttled. Cache lookups
+# of the individual layers run concurrently without contending on this
+# semaphore. The semaphore bounds the number of concurrent requests and
+# the rate limiter bounds the number of requests per second.
+_wmsRequestSem = threading.BoundedSemaphore(
+    int(os.environ.get(
+        "CONCURRENT_GEONORGE_WMS_REQUESTS",
+        default_CONCURRENT_GEONORGE_WMS_REQUESTS)))
+_wmsRequestRateLimiter = _RateLimiter(
+    float(os.environ.get(
+        "GEONORGE_WMS_MIN_REQUEST_INTERVAL_SEC",
+        default_GEONORGE_WMS_MIN_REQUEST_INTERVAL_SEC)))
+
+# The layers of the large tiles are fetched, and the cropped tiles are
+# written to the cache, by long lived worker threads that are shared by
+# all the requests, instead of starting new threads for every large tile.
+# The maps have up to a dozen layers.
+_layerFetchExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=16, thread_name_prefix="geonorge-layer")
+_cropWriterExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="geonorge-crop")
+
+# Creating a transformer loads the PROJ database and is slow, so create
+# it only once. Transformers are thread safe since pyproj 3.1.
+_wgs84ToWebMercator = pyproj.Transformer.from_crs("WGS84", "EPSG:3857")
+
+
+@lru_cache(maxsize=65536)
+def _getTileBounds(z: int, x: int, y: int) -> mercantile.LngLatBbox:
+    return mercantile.bounds(x, y, z)
+
+
+@lru_cache(maxsize=16384)
+def _getWMSBbox(z: int, x: int, y: int, x2: int, y2: int) -> str:
+    # Returns the WMS bbox parameter of the large tile that spans from
+    # tile x/y to tile x2/y2. The same large tile is requested once for
+    # every one of its layers, so only transform its bounds once.
+    bbox1 = _getTileBounds(z, x, y)
+    bbox2 = _getTileBounds(z, x2, y2)
+    south, west, north, east = _wgs84ToWebMercator.transform_bounds(
+        bbox2.south, bbox1.west, bbox1.north, bbox2.east)
+    return "%2C".join(str(coord) for coord in (south, west, north, east))
+
+
+@lru_cache(maxsize=1024)
+def _getTileLayerNamesHash(tileLayerNames: Tuple[str, ...]) -> str:
+    # The layers of a map config don't change, so only hash them once
+    return hashlib.blake2b(
+        "/".join(tileLayerNames).encode(), digest_size=8).hexdigest()
 
 
 class GeonorgeDatasetID(str, enum.Enum):
@@ -36,6 +205,37 @@ class GeonorgeDatasetID(str, enum.Enum):
     WMS_FJELLSKYGGE = "https://openwms.statkart.no/skwms1/wms.fjellskygge?"
 
 
+@lru_cache(maxsize=1024)
+def _getWMSGetMapUrlTemplate(dataset: GeonorgeDatasetID, layer: str,
+                             dpi: int) -> str:
+    # Only the BBOX, WIDTH and HEIGHT parameters of the GetMap requests
+    # change per request, so urlencode the rest of the parameters once per
+    # layer, and leave placeholders for the ones that change
+    placeholders = {"bbox": "{bbox}", "width": "{width}", "height": "{height}"}
+    params = {
+        "SERVICE": "WMS",
+        "VERSION": "1.3.0",
+        "REQUEST": "GetMap",
+        "BBOX": placeholders["bbox"],
+        "CRS": "EPSG:3857",
+        "WIDTH": placeholders["width"],
+        "HEIGHT": placeholders["height"],
+        "LAYERS": layer,
+        "FORMAT": "image/png",
+        "DPI": dpi,
+        "MAP_RESOLUTION": dpi,
+        "STYLE": "default",
+        "TRANSPARENT": "true"
+    }
+    # Escape any braces in the encoded url before restoring the placeholders
+    urlTemplate = urllib.parse.urlencode(params).replace(
+        "{", "{{").replace("}", "}}")
+    for placeholder in placeholders.values():
+        urlTemplate = urlTemplate.replace(
+            urllib.parse.quote_plus(placeholder), placeholder)
+    return dataset.value + urlTemplate
+
+
 class GeonorgeCustomConfig(NamedTuple):
     wmsDataset: GeonorgeDatasetID
     tileLayerName: str
@@ -43,6 +243,20 @@ class GeonorgeCustomConfig(NamedTuple):
     sizePx: int = 512
 
 
+class LargeTileGrid(NamedTuple):
+    # The grid of tiles (tilesToRequest x tilesToRequest) that is requested
+    # with a single WMS request. x/y is the top left tile and x2/y2 the
+    # bottom right tile of the grid, and width/height the size of the
+    # whole grid in pixels.
+    x: int
+    y: int
+    x2: int
+    y2: int
+    width: int
+    height: int
+    tilesToRequest: int
+
+
 class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
     """
     The WMS server of Geonorge (statkart) throttles requests aggressively.
@@ -68,12 +282,16 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
        the composites
     """
 
-    def __init__(self, downloadTimeoutSec: int = 20):
-        self._concurrentLargeTileDownloads = int(
-            os.environ.get(
-                "CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS",
-                default_CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS))
+    def __init__(self, downloadTimeoutSec: int = 20,
+                 memoryCacheMaxEntries: int = 1024):
         self._downloadTimeoutSec = downloadTimeoutSec
+        # Recently served composite tiles are kept in memory in front of the
+        # two-level disk cache
+        self._memoryCache = LRUBlobCache(maxEntries=memoryCacheMaxEntries)
+        self._tileConfHashes: Dict[int, Tuple['BaseTileSetConfig', str]] = {}
+        # Futures of the tiles that are being made, keyed by cache path
+        self._inflight: Dict[str, concurrent.futures.Future] = {}
+        self._inflightLock = threading.Lock()
         super(GeonorgeWMSDownloadProvider, self).__init__()
 
     @property
@@ -85,9 +303,8 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
         self._downloadTimeoutSec = downloadTimeoutSec
 
     def _getXYWH(self, z: int, x: int, y: int,
-                 sizePx: int) -> Tuple[
-            int, int, int, int, int, int, int]:
-        tilesToRequest = 8 if 2 ** z >= 8 else 2 ** z
+                 sizePx: int) -> LargeTileGrid:
+        tilesToRequest = min(8, 1 << z)
 
         x = x - (x % tilesToRequest)
         y = y - (y % tilesToRequest)
@@ -97,7 +314,7 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
         width = sizePx * ((x2 - x) + 1)
         height = sizePx * ((y2 - y) + 1)
 
-        return x, y, x2, y2, width, height, tilesToRequest
+        return LargeTileGrid(x, y, x2, y2, width, height, tilesToRequest)
 
     def _getTileLayerCachePath(
         self,
@@ -105,19 +322,37 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
             z: int, x: int, y: int,
             dpi: int, baseTileSizePx: int) -> str:
 
-        x, y, _, _, width, height, tilesToRequest = self._getXYWH(
-            z, x, y, baseTileSizePx)
+        grid = self._getXYWH(z, x, y, baseTileSizePx)
 
         cacheDir = os.path.join(
-            self._tileCacheBasePath, dataset.name, layer, str(z), str(x))
+            self._tileCacheBasePath, dataset.name, layer, str(z), str(grid.x))
 
-        os.makedirs(cacheDir, exist_ok=True)
         cacheFile = os.path.join(
             cacheDir,
-            f"{y}_{tilesToRequest}x{tilesToRequest}_{baseTileSizePx}px_base_{dpi}dpi_{width}x{height}px.png")
+            self._getTileLayerCacheFileName(grid, dpi, baseTileSizePx))
 
         return cacheFile
 
+    def _getTileLayerCacheFileName(self, grid: LargeTileGrid,
+                                   dpi: int, baseTileSizePx: int) -> str:
+        tilesToRequest = grid.tilesToRequest
+        return f"{grid.y}_{tilesToRequest}x{tilesToRequest}_{baseTileSizePx}px_base_{dpi}dpi_{grid.width}x{grid.height}px.png"
+
+    def _getLargeLockNamespace(self, z: int, x: int, y: int,
+                               mapId: str,
+                               tileConf: 'BaseTileSetConfig') -> str:
+        # The namespace is made of the last three components of the cache
+        # path of the base layer (z, x and the file name), without the
+        # need to build the whole path and split it again
+        customConfig = tileConf.tileServers[0].customConfig
+        grid = self._getXYWH(z, x, y, customConfig.sizePx)
+        fileName = self._getTileLayerCacheFileName(
+            grid, customConfig.dpi, customConfig.sizePx)
+        return os.path.join(
+            self._tileCacheBasePath,
+            mapId,
+            f"{z}_{grid.x}_{fileName}.largeLock")
+
     def getTileLayerCachePath(self, z: int, x: int, y: int,
                               mapId: str,
                               tileConf: 'BaseTileSetConfig',
@@ -131,62 +366,94 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
 
     def _downloadSingleTileLayer(self, url: str) -> Image:
         def downloadSingleTileLayer(url: str):
-            printColor(
-                f"Downloading tile layer from url: {url}",
-                color=bcolors.BLUE)
-            with urllib.request.urlopen(url, timeout=self._downloadTimeoutSec) as conn:
-                return conn.read()
-
-        # Do only one download per second from WMS Geonorge to
-        # limit the throttling
+            with _wmsRequestSem:
+                _wmsRequestRateLimiter.wait()
+                printVerbose(
+                    f"Downloading tile layer from url: {url}",
+                    color=bcolors.BLUE)
+                return defaultConnectionPool.fetchWithHeaders(
+                    url, timeout=self._downloadTimeoutSec)
+
+        # Retry the download with a backoff if we get throttled by
+        # WMS Geonorge. Getting throttled is expected under load, so the
+        # throttled attempts are counted separately from the failed ones.
         maxRetries = 10
+        maxThrottledRetries = 10
         numRetries = 0
+        numThrottledRetries = 0
+        # The namespace lock and the large tile slot of the tile are held
+        # while backing off, so every other large tile waits for this one.
+        # Give up when the retries would take longer than the download
+        # timeout, instead of sleeping for minutes.
+        deadline = time.monotonic() + self._downloadTimeoutSec
+
+        def backoff(reason: str):
+            # Back off linearly with a random factor (2-4s, 4-8s, 6-12s...),
+            # so that concurrent requests that got throttled together
+            # don't retry in lockstep. The WMS request semaphore is not
+            # held while sleeping.
+            backoffSec = random.uniform(2, 4) * numThrottledRetries
+            if time.monotonic() + backoffSec > deadline:
+                raise TimeoutError(
+                    f"{reason} - giving up on {url} after retrying for {self._downloadTimeoutSec} seconds")
+            printColor(
+                f"{reason} - Sleeping {backoffSec:.1f} seconds and retrying",
+                color=bcolors.BROWN)
+            time.sleep(backoffSec)
+
         while True:
-            if numRetries >= maxRetries:
-                raise BaseException(
-                    f"reached max retries ({maxRetries}) and failed to download {url}")
+            if numRetries >= maxRetries or numThrottledRetries >= maxThrottledRetries:
+                raise TileDownloadError(
+                    f"reached max retries ({numRetries} failed, {numThrottledRetries} throttled) and failed to download {url}")
 
-            numRetries += 1
-            data = downloadSingleTileLayer(url)
             try:
-                # Try to parse and return the data as an image - if it fails,
-                # retry to download the same data in case we got throttled
-                # by the remote server
-                return Image(blob=data)
-            except OptionError as e:
-                # This error checking chunk is specific to the geonorge WMS server
-                # that throttles requests aggressively, but returns a 200
-                # response.
-                printColor("Error occured for downloaded image:",
-                           e.args, e.wand_error_code,
-                           color=bcolors.RED)
-                msg = data.decode('ISO-8859-1')
-                if "Overforbruk" in msg:
-                    printColor(
-                        "Overuse error - Sleeping 1 second and retrying",
-                        color=bcolors.BROWN)
-                    time.sleep(1)
+                data, headers = downloadSingleTileLayer(url)
+            except urllib.error.HTTPError as e:
+                # Too many requests or server side errors are worth
+                # retrying after a while - anything else is not
+                if e.code != 429 and e.code < 500:
+                    raise
+                numThrottledRetries += 1
+                backoff(f"HTTP error {e.code}")
+                continue
+
+            # The geonorge WMS server throttles requests aggressively, but
+            # returns a 200 response with a text message instead of an
+            # image. Look at the content type and the magic bytes of the
+            # response first, so that only images are passed to image
+            # magick for decoding.
+            contentType = headers.get("Content-Type", "image/")
+            if contentType.startswith("image/") and getImageFormatFromBlob(data) is not None:
+                try:
+                    return Image(blob=data)
+                except OptionError as e:
+                    printColor("Error occured for downloaded image:",
+                               e.args, e.wand_error_code,
+                               color=bcolors.RED)
+                    numRetries += 1
                     continue
-                else:
-                    printColor(
-                        "Success but not valid image returned - will not retry this one",
-                        color=bcolors.BOLD + bcolors.YELLOW)
 
-    def _getLayerFromGeonorge(
+            # The throttling message is at the beginning of the response
+            msg = data[:4096].decode('ISO-8859-1')
+            if "Overforbruk" in msg:
+                numThrottledRetries += 1
+                backoff("Overuse error")
+                continue
+
+            raise TileDownloadError(
+                f"Success but not valid image returned from {url} - will not retry this one: {msg[:200]}")
+
+    def _getLayerFromLayerCache(
             self,
             z: int, x: int, y: int,
             mapId: str,
             tileConf: 'BaseTileSetConfig',
-            tileServerConf: BaseTileServerConfig) -> Image:
-
-        # If additional locking for the download threads is needed, add a
-        # global "with downloadLock" here:
-        # with downloadLock:
+            tileServerConf: BaseTileServerConfig) -> Optional[Image]:
         try:
             cachedImage, cachePath = self.getTileLayerFromCache(
                 z, x, y, mapId, tileConf, tileServerConf)
             if cachedImage:
-                printColor(
+                printVerbose(
                     f"Loading tile layer from cache: {cachePath}",
                     color=bcolors.WHITE)
                 return cachedImage
@@ -194,82 +461,93 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
             pass
         except wand.exceptions.CorruptImageError:
             pass
+        return None
+
+    def _getLayerFromGeonorge(
+            self,
+            z: int, x: int, y: int,
+            grid: LargeTileGrid,
+            mapId: str,
+            tileConf: 'BaseTileSetConfig',
+            tileServerConf: BaseTileServerConfig) -> Image:
+        cachedImage = self._getLayerFromLayerCache(
+            z, x, y, mapId, tileConf, tileServerConf)
+        if cachedImage:
+            return cachedImage
 
+        return self._fetchLayerFromGeonorge(
+            z, grid, mapId, tileConf, tileServerConf)
+
+    def _fetchLayerFromGeonorge(
+            self,
+            z: int,
+            grid: LargeTileGrid,
+            mapId: str,
+            tileConf: 'BaseTileSetConfig',
+            tileServerConf: BaseTileServerConfig) -> Image:
+        # Only the WMS request itself is throttled (see _wmsRequestSem) -
+        # the rest of the work runs concurrently for all the layers
         dataset = tileServerConf.customConfig.wmsDataset
         layer = tileServerConf.customConfig.tileLayerName
         dpi = tileServerConf.customConfig.dpi
-        sizePx = tileServerConf.customConfig.sizePx
-        url = dataset.value
-
-        x, y, x2, y2, width, height, tilesToRequest = self._getXYWH(
-            z, x, y, sizePx)
-
-        transformer = pyproj.Transformer.from_crs("WGS84", "EPSG:3857")
-        bbox1 = mercantile.bounds(x, y, z)
-        bbox2 = mercantile.bounds(x2, y2, z)
-        south, west, north, east = transformer.transform_bounds(
-            bbox2.south, bbox1.west, bbox1.north, bbox2.east)
-
-        params = {
-            "SERVICE": "WMS",
-            "VERSION": "1.3.0",
-            "REQUEST": "GetMap",
-            "BBOX": "{},{},{},{}".format(south, west, north, east),
-            "CRS": "EPSG:3857",
-            "WIDTH": width,
-            "HEIGHT": height,
-            "LAYERS": layer,
-            "FORMAT": "image/png",
-            "DPI": dpi,
-            "MAP_RESOLUTION": dpi,
-            "STYLE": "default",
-            "TRANSPARENT": "true"
-        }
+
+        urlTemplate = _getWMSGetMapUrlTemplate(dataset, layer, dpi)
+        bbox = _getWMSBbox(z, grid.x, grid.y, grid.x2, grid.y2)
 
         image = self._downloadSingleTileLayer(
-            url + urllib.parse.urlencode(params))
+            urlTemplate.format(bbox=bbox, width=grid.width, height=grid.height))
 
         if tileServerConf.enableTileCache:
             # Cache the downloaded file if the cache for this layer is
             # enabled
             cachePath = self.getTileLayerCachePath(
-                z, x, y, mapId, tileConf, tileServerConf)
-            print(
-                f"Saving tile layer in cache: {cachePath}",
-                file=sys.stderr)
-            with NamespaceLock(cachePath):
-                image.save(filename=cachePath)
+                z, grid.x, grid.y, mapId, tileConf, tileServerConf)
+            printVerbose(
+                f"Saving tile layer in cache: {cachePath}")
+            saveImageAtomically(image, cachePath)
 
         return image
 
     def _makeCompositeFromLayers(self, layers: List[Image]) -> Image:
-        base = layers[0]
-        if len(layers) == 1:
-            return base
-
-        for i in range(1, len(layers)):
-            overlay = layers[i]
-            base = buildCompositeImage(base, overlay)
-
-        return base
+        return buildCompositeFromLayers(layers)
+
+    def _getTileConfHash(self, tileConf: 'BaseTileSetConfig') -> str:
+        # The tile set configs are NamedTuples that hold lists, so they
+        # can neither be hashed nor weakly referenced. Memoize the hash of
+        # their layer names by the id of the config object instead, and
+        # keep a reference to the config so that the id is never reused.
+        cached = self._tileConfHashes.get(id(tileConf))
+        if cached is not None and cached[0] is tileConf:
+            return cached[1]
+
+        tileLayerNames = tuple(
+            tileServer.customConfig.tileLayerName for tileServer in tileConf.tileServers)
+        tileConfHash = _getTileLayerNamesHash(tileLayerNames)
+        self._tileConfHashes[id(tileConf)] = (tileConf, tileConfHash)
+        return tileConfHash
 
     def _getTileCompositeCachePath(self, z: int, x: int, y: int, mapId: str,
                                    tileConf: 'BaseTileSetConfig') -> str:
-        tileLayerNames = []
-        for layerIdx, tileServer in enumerate(tileConf.tileServers):
-            tileLayerNames.append(tileServer.customConfig.tileLayerName)
-        strToHash = "/".join(tileLayerNames)
-        hashCalc = hashlib.blake2b(digest_size=8)
-        hashCalc.update(strToHash.encode())
         cacheDir = os.path.join(
             self._tileCacheBasePath, mapId,
-            hashCalc.hexdigest(),
+            self._getTileConfHash(tileConf),
             str(z), str(x)
         )
-        os.makedirs(cacheDir, exist_ok=True)
         cacheFile = os.path.join(cacheDir, str(y))
         return cacheFile
 
+    def _getTileCompositeCacheTimeoutSec(
+            self, tileConf: 'BaseTileSetConfig') -> int:
+        minTileCacheTimeoutSec = -1
+        for layerIdx, tileServer in enumerate(tileConf.tileServers):
+            if tileServer.enableTileCache:
+                if layerIdx == 0:
+                    minTileCacheTimeoutSec = tileServer.tileCacheTimeoutSec
+                else:
+                    minTileCacheTimeoutSec = min(
+                        minTileCacheTimeoutSec, tileServer.tileCacheTimeoutSec)
+        return minTileCacheTimeoutSec
+
     def _getTileCompositeFromCache(
             self, z: int, x: int, y: int,
             mapId: str,
@@ -279,78 +557,274 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
         make composites and split them every time. So cache the
         composite tiles too.
         """
-        minTileCacheTimeoutSec = -1
-        for layerIdx, tileServer in enumerate(tileConf.tileServers):
-            if tileServer.enableTileCache:
-                if layerIdx == 0:
-                    minTileCacheTimeoutSec = tileServer.tileCacheTimeoutSec
-                else:
-                    minTileCacheTimeoutSec = min(
-                        minTileCacheTimeoutSec, tileServer.tileCacheTimeoutSec)
+        blob, _, path = self._getTileCompositeBlobFromCache(
+            z, x, y, mapId, tileConf)
+        if blob is None:
+            return None, None
 
+        try:
+            return Image(blob=blob), path
+        except wand.exceptions.BlobError:
+            pass
+        return None, None
+
+    def _getTileCompositeBlobFromCache(
+            self, z: int, x: int, y: int,
+            mapId: str,
+            tileConf: 'BaseTileSetConfig') -> Tuple[Optional[bytes], Optional[str], Optional[str]]:
+        """
+        Same as _getTileCompositeFromCache, but returns the encoded
+        tile as it is stored in the cache, without decoding it, and the
+        ETag of the cache file along with the path.
+        """
+        # The cache path identifies the map config and the tile, so it is
+        # used as the key of the in-memory cache too
         path = self._getTileCompositeCachePath(z, x, y, mapId, tileConf)
+        entry = self._memoryCache.getWithETag(path)
+        if entry is not None:
+            blob, etag = entry
+            return blob, etag, path
+
+        cacheTimeoutSec = self._getTileCompositeCacheTimeoutSec(tileConf)
+
+        # Open the file once, and check the expiry on the open file
+        # descriptor. A missing file is reported by the open itself. No
+        # lock is needed to read the cached tiles, as they are written
+        # atomically (see saveBlobAtomically).
         try:
-            lastModTime = os.path.getmtime(path)
-            if time.time() - lastModTime > minTileCacheTimeoutSec:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None, None, None
+
+        with os.fdopen(fd, "rb") as f:
+            st = os.fstat(fd)
+            if time.time() - st.st_mtime > cacheTimeoutSec:
                 printColor(
                     f"Cache expired for composite tile {path}",
                     color=bcolors.YELLOW)
-                return None, None
-        except FileNotFoundError:
-            return None, None
+                return None, None, None
+            if st.st_size == 0:
+                return None, None, None
+            markCacheFileUsed(fd, st)
+            blob = f.read()
 
-        try:
-            with NamespaceLock(path):
-                return Image(filename=path), path
-        except wand.exceptions.BlobError:
-            pass
-        return None, None
+        etag = getTileETag(st)
+        self._memoryCache.put(path, blob, st.st_mtime + cacheTimeoutSec, etag)
+        return blob, etag, path
 
     def _cropLargeCompositeAndCacheIt(
             self, image: Image, sizePx: int,
             z: int, xReq: int, yReq: int,
+            grid: LargeTileGrid,
             mapId: str, tileConf: 'BaseTileSetConfig') -> Image:
-        topLeftX, topLeftY, _, _, _, _, gridSize = self._getXYWH(
-            z, xReq, yReq, sizePx)
+        topLeftX, topLeftY, gridSize = grid.x, grid.y, grid.tilesToRequest
+        cacheTimeoutSec = self._getTileCompositeCacheTimeoutSec(tileConf)
+
+        # The crops are encoded and written to the cache by a pool of
+        # writer threads while the next tiles are being cropped. Image
+        # magick releases the GIL while encoding, so the encoding of the
+        # tiles runs in parallel. The semaphore limits the number of
+        # cropped tiles waiting to be written.
+        pendingCrops = threading.BoundedSemaphore(8)
+
+        def encodeAndCacheCrop(crop: Image, cachePath: str):
+            try:
+                with crop:
+                    # Keep the freshly cropped tiles in memory too, as the
+                    # neighbouring tiles are likely to be requested next
+                    blob = encodeImageForCache(crop)
+                st = saveBlobAtomically(blob, cachePath)
+                self._memoryCache.put(
+                    cachePath, blob, st.st_mtime + cacheTimeoutSec,
+                    getTileETag(st))
+            finally:
+                pendingCrops.release()
+
         retTile = None
-        for xi in range(gridSize):
-            for yi in range(gridSize):
-                x = xi + topLeftX
-                y = yi + topLeftY
-                cachePath = self._getTileCompositeCachePath(
-                    z, x, y, mapId, tileConf)
-                print(f"Cropping and caching {cachePath}", file=sys.stderr)
-                left = xi * sizePx
-                right = left + sizePx
-                top = yi * sizePx
-                bottom = top + sizePx
-                with image[left:right, top:bottom] as crop:
-                    with NamespaceLock(cachePath):
-                        crop.save(filename=cachePath)
-                    if x == xReq and y == yReq:
-                        retTile = crop[:]
+        futures = []
+        try:
+            for xi in range(gridSize):
+                for yi in range(gridSize):
+                    x = xi + topLeftX
+                    y = yi + topLeftY
+                    cachePath = self._getTileCompositeCachePath(
+                        z, x, y, mapId, tileConf)
+                    printVerbose(f"Cropping and caching {cachePath}")
+                    pendingCrops.acquire()
+                    crop = None
+                    try:
+                        # Crop a clone in place. The clone shares the pixel
+                        # cache with the composite, so only the cropped area
+                        # is copied.
+                        crop = image.clone()
+                        crop.crop(left=xi * sizePx, top=yi * sizePx,
+                                  width=sizePx, height=sizePx,
+                                  reset_coords=True)
+                        if x == xReq and y == yReq:
+                            retTile = crop[:]
+                        futures.append(_cropWriterExecutor.submit(
+                            encodeAndCacheCrop, crop, cachePath))
+                    except BaseException:
+                        # The crop never reached a writer
+                        if crop is not None:
+                            crop.close()
+                        pendingCrops.release()
+                        raise
+
+            # Raise any error that occurred while writing the tiles
+            for future in futures:
+                future.result()
+        except BaseException:
+            # Wait for the writes that are still running, and report
+            # their errors too, as only the first error is raised
+            concurrent.futures.wait(futures)
+            for future in futures:
+                if future.exception() is not None:
+                    printColor(
+                        f"Caching a cropped tile failed: {future.exception()}",
+                        color=bcolors.RED)
+            if retTile is not None:
+                retTile.close()
+            raise
         return retTile
 
-    def downloadTile(self, z: int, x: int, y: int,
-                     mapId: str,
-                     tileConf: 'BaseTileSetConfig') -> Image:
+    def getCachedTilePath(self, z: int, x: int, y: int,
+                          mapId: str,
+                          tileConf: 'BaseTileSetConfig') -> Optional[str]:
+        # Composite tiles are cached as PNG images that can be sent to
+        # the client as they are stored in the cache. Tiles that are kept
+        # in memory are served from memory by downloadTileBlob instead.
+        if tileConf.filetype not in (ImageFileType.AUTO, ImageFileType.PNG):
+            return None
+
+        path = self._getTileCompositeCachePath(z, x, y, mapId, tileConf)
+        if self._memoryCache.get(path) is not None:
+            return None
 
-        def tryCompositeCache():
-            tile, tileCachePath = self._getTileCompositeFromCache(
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if st.st_size == 0 or time.time() - st.st_mtime > self._getTileCompositeCacheTimeoutSec(tileConf):
+            return None
+        return path
+
+    def downloadTileBlob(self, z: int, x: int, y: int,
+                         mapId: str,
+                         tileConf: 'BaseTileSetConfig') -> TileBlob:
+        # Composite tiles are cached as PNG images. Serve them as they
+        # are stored in the cache, unless a different file type has been
+        # requested for this map, to avoid decoding and re-encoding them.
+        if tileConf.filetype not in (ImageFileType.AUTO, ImageFileType.PNG):
+            return super(GeonorgeWMSDownloadProvider, self).downloadTileBlob(
                 z, x, y, mapId, tileConf)
-            if tile:
-                printColor(
-                    f"Tile fetched from cache: {tileCachePath}",
-                    color=bcolors.GREEN)
-            return tile
 
+        tileBlob = self._getTileCompositeTileBlob(z, x, y, mapId, tileConf)
+        if tileBlob is not None:
+            return tileBlob
+
+        # A freshly made tile is served as it was written to the cache (it
+        # is still in memory), so that it has the same content and ETag as
+        # when it is served from the cache later on. The requests that
+        # waited for another request to make the tile read it from there
+        # too, without decoding it.
+        tile = self._makeTileOnce(z, x, y, mapId, tileConf)
+        if tile is None:
+            tileBlob = self._getTileCompositeTileBlob(z, x, y, mapId, tileConf)
+            if tileBlob is not None:
+                return tileBlob
+            tile = self.downloadTile(z, x, y, mapId, tileConf)
+        with tile:
+            tileBlob = self._getTileCompositeTileBlob(z, x, y, mapId, tileConf)
+            if tileBlob is not None:
+                return tileBlob
+            return self._encodeTile(tile, tileConf)
+
+    def _getTileCompositeTileBlob(self, z: int, x: int, y: int,
+                                  mapId: str,
+                                  tileConf: 'BaseTileSetConfig') -> Optional[TileBlob]:
+        blob, etag, tileCachePath = self._getTileCompositeBlobFromCache(
+            z, x, y, mapId, tileConf)
+        if not blob:
+            return None
+        imageFormat = getImageFormatFromBlob(blob)
+        if imageFormat is None:
+            return None
+        printVerbose(
+            f"Tile fetched from cache: {tileCachePath}",
+            color=bcolors.GREEN)
+        return TileBlob(blob, imageFormat, etag)
+
+    def _tryCompositeCache(self, z: int, x: int, y: int,
+                           mapId: str,
+                           tileConf: 'BaseTileSetConfig') -> Optional[Image]:
+        tile, tileCachePath = self._getTileCompositeFromCache(
+            z, x, y, mapId, tileConf)
+        if tile:
+            printVerbose(
+                f"Tile fetched from cache: {tileCachePath}",
+                color=bcolors.GREEN)
+        return tile
+
+    def downloadTile(self, z: int, x: int, y: int,
+                     mapId: str,
+                     tileConf: 'BaseTileSetConfig') -> Image:
         # Requests are processed concurrently by the threaded HTTP server.
         # Try to fetch a composite tile if it exists in the cache right away
         # before applying any locking.
-        tile = tryCompositeCache()
+        tile = self._tryCompositeCache(z, x, y, mapId, tileConf)
         if tile:
             return tile
 
+        tile = self._makeTileOnce(z, x, y, mapId, tileConf)
+        if tile is None:
+            # Another request made the tile - read it back from the cache
+            tile = self._tryCompositeCache(z, x, y, mapId, tileConf)
+            if tile is None:
+                tile = self._downloadAndCropTile(z, x, y, mapId, tileConf)
+        return tile
+
+    def _makeTileOnce(self, z: int, x: int, y: int,
+                      mapId: str,
+                      tileConf: 'BaseTileSetConfig') -> Optional[Image]:
+        # Coalesce concurrent requests for the same tile: the first request
+        # makes the tile and returns it, and the rest wait until it has
+        # been made and return None, instead of queueing on the namespace
+        # lock one after the other. The made tile is in the caches by then
+        # (see _cropLargeCompositeAndCacheIt), so the waiting requests read
+        # it from there, and no image magick image is shared between the
+        # request threads.
+        path = self._getTileCompositeCachePath(z, x, y, mapId, tileConf)
+        with self._inflightLock:
+            future = self._inflight.get(path)
+            isOwner = future is None
+            if isOwner:
+                future = concurrent.futures.Future()
+                self._inflight[path] = future
+
+        if not isOwner:
+            printVerbose(
+                f"Waiting for the in-flight request of {path}",
+                color=bcolors.BROWN)
+            future.result()
+            return None
+
+        try:
+            tile = self._downloadAndCropTile(z, x, y, mapId, tileConf)
+        except BaseException as e:
+            with self._inflightLock:
+                del self._inflight[path]
+            future.set_exception(e)
+            raise
+
+        with self._inflightLock:
+            del self._inflight[path]
+        future.set_result(None)
+        return tile
+
+    def _downloadAndCropTile(self, z: int, x: int, y: int,
+                             mapId: str,
+                             tileConf: 'BaseTileSetConfig') -> Image:
         # If the composite tile was not found in the cache, make sure that
         # we download large tiles layers only once by using a namespaced lock.
         # This is needed as, for example, the following two requests:
@@ -362,12 +836,7 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
         #
         # So the common working namespace for these two requests is:
         # 12_2192_1064_8x8_512px_base_192dpi_4096x4096px.png
-        baseNs = self.getTileLayerCachePath(
-            z, x, y, mapId, tileConf, tileConf.tileServers[0]).split(os.sep)[-3:]
-        ns = os.path.join(
-            self._tileCacheBasePath,
-            mapId,
-            f"{baseNs[0]}_{baseNs[1]}_{baseNs[2]}.largeLock")
+        ns = self._getLargeLockNamespace(z, x, y, mapId, tileConf)
 
         # Use a namespace lock to prevent multiple downloads of large tile layers
         # by different concurrent requests.
@@ -376,62 +845,77 @@ class GeonorgeWMSDownloadProvider(BaseDownloadProvider):
         # cropping and caching, and any subsequent request that shares the same
         # namespace will fetch the tiles from the cache.
         with NamespaceLock(ns):
-            printColor(
+            printVerbose(
                 f"Namespace lock {ns} acquired by request {mapId}/{z}/{x}/{y}",
                 color=bcolors.BROWN)
             # First thing when entering the critical section protected by the lock
             # is to try to fetch the tiles again from the cache. The majority of
             # the requests (technically any request, except the first one that shares
             # the namespace lock) will hit the cache here.
-            tile = tryCompositeCache()
+            tile = self._tryCompositeCache(z, x, y, mapId, tileConf)
             if tile:
                 return tile
 
-            def getLargeLockList() -> List[str]:
-                # Get a list of large locks from the namespace lock.
-                # Sort them by refcount (refcount points to how many
-                # requests are waiting for this lock to be released),
-                # to prioritize locks that will serve more tiles before
-                # (hopefully) timing out
-                return [lock for lock in getListOfActiveLocks(sorted_by_refcount=True).keys() if lock.endswith(".largeLock")]
-
-            # Do not process more than one large lock (downloading of
-            # massive tiles) simultaneously - we risk running out of
-            # memory and geonorge is terribly slow any way.
-            maxActiveLargeLocks = self._concurrentLargeTileDownloads
-            largeLockList = getLargeLockList()
-            while len(largeLockList) > maxActiveLargeLocks:
-                if ns not in largeLockList[:maxActiveLargeLocks]:
-                    time.sleep(0.1)
-                    largeLockList = getLargeLockList()
-                else:
-                    # Process the lock if it's in the top of the sorted list by
-                    # lock refcount
-                    printColor(f"Will now process {ns}", bcolors.UNDERLINE)
-                    break
-
-            sizePx = 0
-            dpi = 0
-            for layerIdx, tileServerConf in enumerate(tileConf.tileServers):
-                if layerIdx == 0:
-                    dpi = tileServerConf.customConfig.dpi
-                    sizePx = tileServerConf.customConfig.sizePx
-                else:
-                    layerName = tileServerConf.customConfig.tileLayerName
-                    layerDpi = tileServerConf.customConfig.dpi
-                    layerSize = tileServerConf.customConfig.sizePx
-                    if layerDpi != dpi or layerSize != sizePx:
-                        raise BaseException(
-                            f"Layer {layerName} has a different dpi/sizePx ({layerDpi}/{layerSize}) from the previous layers ({dpi}/{sizePx})")
-
-            downloadedLayers = []
-            for tileServerConf in tileConf.tileServers:
-                layer = self._getLayerFromGeonorge(
-                    z, x, y, mapId, tileConf, tileServerConf)
-                downloadedLayers.append(layer)
+            # Wait for a free large tile slot without holding up other
+            # namespaces - the large lock with the most waiting requests
+            # is processed first
+            with _largeTileAdmission.admit(ns):
+                printVerbose(f"Will now process {ns}", color=bcolors.UNDERLINE)
+                return self._makeAndCropLargeTile(z, x, y, mapId, tileConf)
 
+    def _makeAndCropLargeTile(self, z: int, x: int, y: int,
+                              mapId: str,
+                              tileConf: 'BaseTileSetConfig') -> Image:
+        sizePx = 0
+        dpi = 0
+        for layerIdx, tileServerConf in enumerate(tileConf.tileServers):
+            if layerIdx == 0:
+                dpi = tileServerConf.customConfig.dpi
+                sizePx = tileServerConf.customConfig.sizePx
+            else:
+                layerName = tileServerConf.customConfig.tileLayerName
+                layerDpi = tileServerConf.customConfig.dpi
+                layerSize = tileServerConf.customConfig.sizePx
+                if layerDpi != dpi or layerSize != sizePx:
+                    raise TileDownloadError(
+                        f"Layer {layerName} has a different dpi/sizePx ({layerDpi}/{layerSize}) from the previous layers ({dpi}/{sizePx})")
+
+        # All the layers share the same grid, so compute it only once
+        grid = self._getXYWH(z, x, y, sizePx)
+
+        # Fetch all the layers concurrently. Layers found in the cache
+        # are loaded right away, and only the cache misses contend on
+        # the WMS request semaphore.
+        futures = [
+            _layerFetchExecutor.submit(
+                self._getLayerFromGeonorge,
+                z, x, y, grid, mapId, tileConf, tileServerConf)
+            for tileServerConf in tileConf.tileServers]
+        try:
+            # Collect the layers in the order that is needed for the
+            # composite
+            downloadedLayers = [future.result() for future in futures]
             compositeTile = self._makeCompositeFromLayers(downloadedLayers)
-
+        except BaseException:
+            # Release all the layers that were fetched, including the ones
+            # that finish after the error, as each one of them can hold
+            # several hundred MB of pixels
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            for future in futures:
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
+            raise
+
+        # The large layers hold several hundred MB of pixels for maps
+        # with many layers. The overlays are not needed once they have
+        # been composited on the base layer, so release them right away
+        # instead of waiting for the garbage collector.
+        for layer in downloadedLayers[1:]:
+            layer.close()
+
+        with compositeTile:
             tile = self._cropLargeCompositeAndCacheIt(
-                compositeTile, sizePx, z, x, y, mapId, tileConf)
-            return tile
+                compositeTile, sizePx, z, x, y, grid, mapId, tileConf)
+        return tile
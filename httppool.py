@@ -0,0 +1,271 @@
+import base64
+import gzip
+import http.client
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zlib
+from collections import deque
+from threading import Lock
+from typing import Deque, Dict, Optional, Tuple
+
+# Keep-alive connections towards the tile servers. urllib.request.urlopen
+# opens a new TCP (and TLS) connection for every request, which costs one
+# or two round trips before the first byte of a tile can be requested.
+# The HTTPConnectionPool keeps the idle connections around per host and
+# reuses them for subsequent requests to the same host.
+#
+# Like urlopen, the pool honors the proxies of the environment
+# (HTTP_PROXY, HTTPS_PROXY and NO_PROXY). Plain HTTP requests are sent to
+# the proxy with the absolute url of the tile, and HTTPS requests are
+# tunneled through the proxy with CONNECT.
+
+_MAX_REDIRECTS = 5
+# Send the same User-Agent as urllib.request does, as some tile servers
+# reject requests without one
+_USER_AGENT = f"Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}"
+
+ConnKey = Tuple[str, str]
+# The host:port of a proxy, and the Proxy-Authorization header to send to
+# it (if the proxy url has credentials)
+ProxyConf = Tuple[str, Optional[str]]
+
+
+class HostHealth:
+    # Remembers the hosts that failed recently, so that the providers can
+    # skip them when a tile can be downloaded from other servers. A host
+    # that fails with a 429 or 5xx response, or with a connection error,
+    # is skipped for minBackoffSec seconds, and the backoff doubles with
+    # every consecutive failure up to maxBackoffSec. A successful response
+    # resets the host.
+    def __init__(self, minBackoffSec: float = 1, maxBackoffSec: float = 60):
+        self._minBackoffSec = minBackoffSec
+        self._maxBackoffSec = maxBackoffSec
+        self._lock = Lock()
+        self._failures: Dict[str, int] = {}
+        self._badUntil: Dict[str, float] = {}
+
+    def isHealthy(self, host: str) -> bool:
+        # Dict lookups are atomic, so the healthy hosts are checked
+        # without taking the lock
+        badUntil = self._badUntil.get(host)
+        return badUntil is None or time.monotonic() >= badUntil
+
+    def reportFailure(self, host: str):
+        with self._lock:
+            failures = self._failures.get(host, 0)
+            self._failures[host] = failures + 1
+            self._badUntil[host] = time.monotonic() + min(
+                self._maxBackoffSec, self._minBackoffSec * (1 << min(failures, 16)))
+
+    def reportSuccess(self, host: str):
+        if host not in self._failures:
+            return
+        with self._lock:
+            self._failures.pop(host, None)
+            self._badUntil.pop(host, None)
+
+
+# The content encodings that _decodeContent can decode
+_DECODABLE_ENCODINGS = ("gzip", "x-gzip", "deflate", "identity")
+
+
+def _filterAcceptEncoding(acceptEncoding: str) -> str:
+    # Only advertise the content encodings that can be decoded, so that
+    # the servers don't send e.g. br or zstd compressed tiles because the
+    # configured headers (copied from a browser) accept them
+    codings = [coding.strip() for coding in acceptEncoding.split(",")
+               if coding.split(";")[0].strip().lower() in _DECODABLE_ENCODINGS]
+    return ", ".join(codings) or "identity"
+
+
+def _decodeContent(data: bytes, headers: http.client.HTTPMessage) -> bytes:
+    encoding = headers.get("Content-Encoding", "identity").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        return gzip.decompress(data)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Some servers send raw deflate streams without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+
+class HTTPConnectionPool:
+    def __init__(self, maxIdlePerHost: int = 16,
+                 proxies: Optional[Dict[str, str]] = None):
+        self._maxIdlePerHost = maxIdlePerHost
+        self.hostHealth = HostHealth()
+        self._lock = Lock()
+        self._idle: Dict[ConnKey, Deque[http.client.HTTPConnection]] = {}
+        # The proxies are read from the environment only once, and the
+        # proxy of every host is looked up only once
+        self._proxies = urllib.request.getproxies() if proxies is None else proxies
+        self._hostProxies: Dict[ConnKey, Optional[ProxyConf]] = {}
+
+    def _getProxy(self, key: ConnKey) -> Optional[ProxyConf]:
+        # Returns the proxy to connect to the given host through, or None
+        # if the host has to be connected to directly
+        if key in self._hostProxies:
+            return self._hostProxies[key]
+
+        scheme, netloc = key
+        proxyUrl = self._proxies.get(scheme)
+        proxy = None
+        if proxyUrl and not urllib.request.proxy_bypass(
+                urllib.parse.urlsplit(f"//{netloc}").hostname or netloc):
+            if "://" not in proxyUrl:
+                proxyUrl = f"http://{proxyUrl}"
+            parts = urllib.parse.urlsplit(proxyUrl)
+            proxyAuth = None
+            if parts.username is not None:
+                credentials = urllib.parse.unquote(parts.username)
+                if parts.password is not None:
+                    credentials += f":{urllib.parse.unquote(parts.password)}"
+                proxyAuth = f"Basic {base64.b64encode(credentials.encode()).decode()}"
+            proxy = (parts.netloc.rpartition("@")[2], proxyAuth)
+
+        self._hostProxies[key] = proxy
+        return proxy
+
+    def _newConnection(self, key: ConnKey,
+                       timeout: float) -> http.client.HTTPConnection:
+        scheme, netloc = key
+        proxy = self._getProxy(key)
+        if proxy is None:
+            if scheme == "https":
+                return http.client.HTTPSConnection(netloc, timeout=timeout)
+            return http.client.HTTPConnection(netloc, timeout=timeout)
+
+        proxyNetloc, proxyAuth = proxy
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(proxyNetloc, timeout=timeout)
+            conn.set_tunnel(
+                netloc,
+                headers=None if proxyAuth is None else {"Proxy-Authorization": proxyAuth})
+            return conn
+        return http.client.HTTPConnection(proxyNetloc, timeout=timeout)
+
+    def _getConnection(
+            self, key: ConnKey,
+            timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        # Returns a connection for the given host, and whether the
+        # connection is a reused one
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self._newConnection(key, timeout), False
+
+    def _putConnection(self, key: ConnKey,
+                       conn: http.client.HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self._maxIdlePerHost:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, url: str, headers: Dict[str, str],
+                 timeout: float) -> Tuple[int, str, http.client.HTTPMessage, bytes]:
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        target = urllib.parse.urlunsplit(
+            ("", "", parts.path or "/", parts.query, ""))
+        proxy = self._getProxy(key)
+        if proxy is not None and parts.scheme == "http":
+            # Plain HTTP proxies expect the absolute url of the resource
+            target = urllib.parse.urlunsplit(
+                (parts.scheme, parts.netloc, parts.path or "/", parts.query, ""))
+            if proxy[1] is not None:
+                headers = {**headers, "Proxy-Authorization": proxy[1]}
+
+        while True:
+            conn, reused = self._getConnection(key, timeout)
+            try:
+                conn.request("GET", target, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected,
+                    http.client.BadStatusLine,
+                    ConnectionResetError,
+                    BrokenPipeError):
+                conn.close()
+                # The server may have closed an idle keep-alive connection
+                # - retry once on a fresh connection
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._putConnection(key, conn)
+            return resp.status, resp.reason, resp.headers, data
+
+    def fetch(self, url: str, headers: Optional[Dict[str, str]] = None,
+              timeout: float = 10) -> bytes:
+        # Downloads the url and returns the received bytes
+        data, _ = self.fetchWithHeaders(url, headers, timeout)
+        return data
+
+    def fetchWithHeaders(
+            self, url: str, headers: Optional[Dict[str, str]] = None,
+            timeout: float = 10) -> Tuple[bytes, http.client.HTTPMessage]:
+        # Downloads the url and returns the received bytes together with
+        # the response headers. Similarly to urllib.request.urlopen,
+        # redirects are followed and an urllib.error.HTTPError is raised
+        # for error responses. Unlike urlopen, gzip and deflate encoded
+        # responses are decoded.
+        reqHeaders = {"Connection": "keep-alive", "User-Agent": _USER_AGENT}
+        if headers is not None:
+            reqHeaders.update(headers)
+            for name, value in headers.items():
+                if name.lower() == "accept-encoding":
+                    reqHeaders[name] = _filterAcceptEncoding(value)
+
+        for _ in range(_MAX_REDIRECTS + 1):
+            host = urllib.parse.urlsplit(url).netloc
+            try:
+                status, reason, respHeaders, data = self._request(
+                    url, reqHeaders, timeout)
+            except (OSError, http.client.HTTPException):
+                self.hostHealth.reportFailure(host)
+                raise
+            if status == 429 or status >= 500:
+                self.hostHealth.reportFailure(host)
+            else:
+                self.hostHealth.reportSuccess(host)
+            location = respHeaders.get("Location")
+            if status in (301, 302, 303, 307, 308) and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if status >= 400:
+                raise urllib.error.HTTPError(
+                    url, status, reason, respHeaders, None)
+            return _decodeContent(data, respHeaders), respHeaders
+
+        raise urllib.error.HTTPError(
+            url, status, f"Too many redirects ({_MAX_REDIRECTS})",
+            respHeaders, None)
+
+
+# A process wide connection pool shared by all the download providers
+defaultConnectionPool = HTTPConnectionPool()
@@ -1,22 +1,37 @@
 import traceback
-from copy import deepcopy
+from collections import defaultdict
+from operator import itemgetter
 from threading import Lock
-from typing import Dict, Union
+from typing import DefaultDict, Dict, List, Union
 
-_namespaceLock = Lock()
-_namespace: Dict[str, Lock] = {}
-_lockCounter: Dict[str, int] = {}
+# The namespace locks are spread over a number of shards, each one
+# protected by its own lock, so that threads that work on unrelated
+# namespaces don't contend on a single process wide lock
+_NUM_SHARDS = 32
+
+
+class _Shard:
+    def __init__(self):
+        self.lock = Lock()
+        self.namespace: Dict[str, Lock] = {}
+        self.lockCounter: DefaultDict[str, int] = defaultdict(int)
+
+
+_shards: List[_Shard] = [_Shard() for _ in range(_NUM_SHARDS)]
+
+
+def _getShard(namespace: str) -> _Shard:
+    return _shards[hash(namespace) & (_NUM_SHARDS - 1)]
 
 
 def getListOfActiveLocks(return_str: bool = False, sorted_by_refcount: bool = False) -> Union[Dict[str, int], str]:
     locks = {}
-    with _namespaceLock:
-        if not sorted_by_refcount:
-            locks = deepcopy(_lockCounter)
-        else:
-            locks = {
-                ns: refcount for ns, refcount in reversed(sorted(_lockCounter.items(), key=lambda item: item[1]))
-            }
+    for shard in _shards:
+        with shard.lock:
+            locks.update(shard.lockCounter)
+
+    if sorted_by_refcount:
+        locks = dict(sorted(locks.items(), key=itemgetter(1), reverse=True))
 
     if return_str:
         ret_str = "[\n  "
@@ -30,23 +45,22 @@ def getListOfActiveLocks(return_str: bool = False, sorted_by_refcount: bool = Fa
 class NamespaceLock:
     def __init__(self, namespace: str):
         self._namespace = namespace
-        with _namespaceLock:
-            if self._namespace not in _namespace.keys():
-                _namespace[self._namespace] = Lock()
-                _lockCounter[self._namespace] = 1
-            else:
-                _lockCounter[self._namespace] += 1
+        self._shard = _getShard(namespace)
+        with self._shard.lock:
+            if self._namespace not in self._shard.namespace:
+                self._shard.namespace[self._namespace] = Lock()
+            self._shard.lockCounter[self._namespace] += 1
 
     def __enter__(self):
-        _namespace[self._namespace].acquire()
+        self._shard.namespace[self._namespace].acquire()
 
     def __exit__(self, exc_type, exc_value, tb):
-        with _namespaceLock:
-            lock = _namespace[self._namespace]
-            _lockCounter[self._namespace] -= 1
-            if _lockCounter[self._namespace] == 0:
-                lock = _namespace.pop(self._namespace)
-                del _lockCounter[self._namespace]
+        with self._shard.lock:
+            lock = self._shard.namespace[self._namespace]
+            self._shard.lockCounter[self._namespace] -= 1
+            if self._shard.lockCounter[self._namespace] == 0:
+                lock = self._shard.namespace.pop(self._namespace)
+                del self._shard.lockCounter[self._namespace]
             lock.release()
 
         if exc_type is not None:
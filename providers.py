@@ -1,16 +1,19 @@
 import concurrent.futures
 import hashlib
+import itertools
 import os
 import sys
+import threading
 import time
-import urllib.request
 from abc import ABC, abstractmethod
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
-from random import randint
 from typing import (
     Any,
+    Callable,
     Dict,
+    Iterator,
     List,
     NamedTuple,
     Optional,
@@ -22,10 +25,27 @@ from typing import (
 import wand
 from wand.image import Image
 
-from nslock import NamespaceLock
+from httppool import defaultConnectionPool
+from tilecache import LRUBlobCache, markCacheFileUsed
 
 _POSIX_PROG_NAME = "slippy-tile-proxy"
 
+# For PNG images, image magick uses the tens digit of the compression
+# quality as the zlib compression level and the ones digit as the filter
+# type: 15 is zlib level 1 with adaptive filtering
+_CACHE_PNG_COMPRESSION_QUALITY = 15
+
+# Set VERBOSE_LOGGING to 1 to print a message for every served tile, and
+# for every tile layer that is downloaded, loaded from or saved in the
+# cache. Warnings and errors are always printed.
+default_VERBOSE_LOGGING = 0
+verboseLogging = int(os.environ.get(
+    "VERBOSE_LOGGING", default_VERBOSE_LOGGING)) != 0
+
+
+class TileDownloadError(Exception):
+    pass
+
 
 class bcolors:
     PURPLE = '\033[95m'
@@ -49,29 +69,189 @@ def printColor(*args, color: bcolors = bcolors.ENDC):
     pstderr(color, *args, bcolors.ENDC)
 
 
+def printVerbose(*args, color: bcolors = bcolors.ENDC):
+    # Used for the messages that are printed for every served tile. They
+    # are only printed if VERBOSE_LOGGING is enabled, as writing them
+    # contends on the stderr lock of the process under load.
+    if verboseLogging:
+        printColor(*args, color=color)
+
+
 def buildCompositeImage(base: Image, overlay: Image) -> Image:
     # Compose a base image and an overlay, and return the
     # generated PNG image
+    return buildCompositeFromLayers([base, overlay])
 
-    # Enforce base and overlay to be a PNG - if not, and the base is
-    # a jpg image, image magick will assume the base format as the default
+
+def buildCompositeFromLayers(layers: List[Image]) -> Image:
+    # Compose all the layers on top of the first (base) layer and return
+    # the generated PNG image. The overlays are composited in place on the
+    # base image, so no intermediate images are allocated.
+    base = layers[0]
+    if len(layers) == 1:
+        return base
+
+    # Enforce base to be a PNG - if not, and the base is a jpg image,
+    # image magick will assume the base format as the default
     base.format = "png"
-    overlay.format = "png"
 
-    bw, bh = base.size
-    ow, oh = overlay.size
+    # Find the smallest layer first, so that the base is resized at most
+    # once. Fully transparent overlays still count, so that the size of
+    # the composite doesn't depend on the content of the overlays.
+    minWidth, minHeight = min(
+        (layer.size for layer in layers), key=lambda size: size[0])
+
+    # Overlays without any visible pixel (very common for the sparse
+    # overlay layers at low zoom levels) don't change the composite, so
+    # they are neither resized nor composited
+    overlays = [
+        overlay for overlay in layers[1:] if not isFullyTransparent(overlay)]
+
+    # Resize any layer that doesn't match the width/height of the
+    # smallest layer
+    for layer in [base] + overlays:
+        if layer.size != (minWidth, minHeight):
+            resizeLayer(layer, minWidth, minHeight)
 
-    # Resize base or overlay to the width/height of the smallest layer
-    if bw != ow:
-        if bw > ow:
-            base.resize(ow, oh)
-        else:
-            overlay.resize(bw, bh)
+    for overlay in overlays:
+        base.composite(overlay, left=0, top=0, operator="over")
 
-    base.composite(overlay)
     return base
 
 
+def resizeLayer(layer: Image, width: int, height: int):
+    # The layers are only ever scaled down to the size of the smallest
+    # layer, and the tiles are viewed at 1:1. A box filter (averaging each
+    # block of pixels) is exact for integer ratios such as 512 -> 256, and
+    # a triangle (bilinear) filter is good enough for any other ratio. Both
+    # are much cheaper than image magick's default filters.
+    if layer.width % width == 0 and layer.height % height == 0:
+        layer.resize(width, height, filter="box")
+    else:
+        layer.resize(width, height, filter="triangle")
+
+
+def isFullyTransparent(image: Image) -> bool:
+    # True if the image has an alpha channel and none of its pixels is
+    # even partly visible
+    if not image.alpha_channel:
+        return False
+    _, maxAlpha = image.range_channel("alpha")
+    return maxAlpha == 0
+
+
+def _createTempFile(cacheDir: str, fileName: str) -> Tuple[int, str]:
+    # Unlike tempfile.mkstemp, which creates the files with mode 0600,
+    # the cache files are created with the permissions of the umask (as
+    # open() does), so that the cache can be shared with other users
+    tmpPath = os.path.join(cacheDir, f".{fileName}.{os.urandom(6).hex()}.tmp")
+    return os.open(tmpPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), tmpPath
+
+
+def saveBlobAtomically(blob: bytes, path: str) -> os.stat_result:
+    # Write the blob to a temporary file in the same directory and rename
+    # it to the final path. The rename is atomic, so concurrent readers
+    # always see either the old or the new complete file, and no lock is
+    # needed when writing to the cache. Returns the status of the written
+    # file (the rename keeps its modification time).
+    cacheDir, fileName = os.path.split(path)
+    try:
+        fd, tmpPath = _createTempFile(cacheDir, fileName)
+    except FileNotFoundError:
+        # The cache directories are only created when the first file is
+        # written in them, so that the cache lookups never have to
+        # create (or stat) any directories
+        os.makedirs(cacheDir, exist_ok=True)
+        fd, tmpPath = _createTempFile(cacheDir, fileName)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+            f.flush()
+            st = os.fstat(fd)
+        os.replace(tmpPath, path)
+        return st
+    except BaseException:
+        try:
+            os.unlink(tmpPath)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def encodeImageForCache(image: Image) -> bytes:
+    # Encode the image in its own format. The caches are local to the
+    # machine, so PNG images are written with the fastest zlib level
+    # (trading a bit of disk space for much less CPU time spent while
+    # encoding). Other formats are encoded with their own settings.
+    if image.format is None or image.format.lower() != "png":
+        return image.make_blob()
+
+    quality = image.compression_quality
+    image.compression_quality = _CACHE_PNG_COMPRESSION_QUALITY
+    try:
+        return image.make_blob()
+    finally:
+        image.compression_quality = quality
+
+
+def saveImageAtomically(image: Image, path: str) -> os.stat_result:
+    # Encode the image for the cache and write it atomically
+    return saveBlobAtomically(encodeImageForCache(image), path)
+
+
+def getTileETag(st: os.stat_result) -> str:
+    # The cached tiles are replaced atomically, so the modification time
+    # and the size of a cache file identify its content without reading
+    # it. Tiles that are served from memory carry the ETag of the file
+    # they were read from (or written to), so that the same tile gets the
+    # same ETag whether it is sent from memory or from the disk.
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+@lru_cache(maxsize=None)
+def _compileDynGetTileUrl(source: str) -> Callable[[int, int, int], str]:
+    # Execute the source of a "dynUrl" tile server only once, in a private
+    # namespace, and return the dynGetTileUrl function that it defines.
+    # The function is then reused for all the tile requests.
+    namespace: Dict[str, Any] = {}
+    exec(source, namespace)
+    return namespace["dynGetTileUrl"]
+
+
+@lru_cache(maxsize=None)
+def _getTileServerHash(firstServer: str, urlFmt: str) -> str:
+    # The hash only depends on the tile server configuration, so compute
+    # it only once per tile server
+    return hashlib.blake2b(
+        f"{firstServer}{urlFmt}".encode(), digest_size=8).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _getUrlTemplateCycle(protocol: str, servers: Tuple[str, ...],
+                         urlFmt: str) -> Iterator[Tuple[str, str]]:
+    # The tile servers are used in a round-robin fashion, so that the load
+    # is spread evenly over them. next() on an itertools.cycle is atomic,
+    # so the cycle can be shared by the request threads without a lock.
+    # The protocol and the server are part of the url templates, so that
+    # building a url takes a single str.format() call.
+    return itertools.cycle(
+        [(server, f"{protocol}://{server}/{urlFmt}") for server in servers])
+
+
+def getTileCacheBasePath() -> str:
+    # All the download providers keep their caches under this directory
+    return os.path.join(Path.home(), ".cache", _POSIX_PROG_NAME)
+
+
+def getImageFormatFromBlob(blob: bytes) -> Optional[str]:
+    # Detect the image format from the magic bytes of an encoded image
+    if blob.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if blob.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    return None
+
+
 class TileServerProtocol(str, Enum):
     HTTP = "http"
     HTTPS = "https"
@@ -110,10 +290,20 @@ class BaseTileServerConfig(NamedTuple):
     customConfig: Optional[Any] = None
 
 
+class TileBlob(NamedTuple):
+    # The encoded tile
+    data: bytes
+    # The image format of the encoded tile (e.g. "png" or "jpeg") that can
+    # be used in the content type of the response
+    imageFormat: str
+    # The ETag of the cache file that holds exactly these bytes (see
+    # getTileETag), or None if the tile is not stored as it is in the cache
+    etag: Optional[str] = None
+
+
 class BaseDownloadProvider(ABC):
     def __init__(self):
-        self._tileCacheBasePath = os.path.join(
-            Path.home(), ".cache", _POSIX_PROG_NAME)
+        self._tileCacheBasePath = getTileCacheBasePath()
         os.makedirs(self._tileCacheBasePath, exist_ok=True)
 
     @abstractmethod
@@ -123,40 +313,68 @@ class BaseDownloadProvider(ABC):
                               tileServerConf: BaseTileServerConfig) -> str:
         ...
 
-    def getTileLayerFromCache(
+    def getFreshTileLayerCachePath(
             self, z: int, x: int, y: int,
             mapId: str,
             tileConf: 'BaseTileSetConfig',
-            tileServerConf: BaseTileServerConfig) -> Tuple[Optional[Image], Optional[str]]:
+            tileServerConf: BaseTileServerConfig) -> Optional[str]:
+        # Returns the cache path of the tile layer if the layer is cached
+        # and has not expired, or None otherwise
         if tileServerConf.enableTileCache is False:
-            return None, None
+            return None
 
         path = self.getTileLayerCachePath(
             z, x, y, mapId, tileConf, tileServerConf)
         try:
-            lastModTime = os.path.getmtime(path)
-            if time.time() - lastModTime > tileServerConf.tileCacheTimeoutSec:
-                printColor(
-                    f"Cache expired for tile {path}",
-                    color=bcolors.YELLOW)
-                return None, None
+            st = os.stat(path)
         except FileNotFoundError:
-            return None, None
+            return None
+
+        if time.time() - st.st_mtime > tileServerConf.tileCacheTimeoutSec:
+            printColor(
+                f"Cache expired for tile {path}",
+                color=bcolors.YELLOW)
+            return None
 
-        st = os.stat(path)
         if st.st_size == 0:
             printColor(
                 f"Zero bytes file in cache ignored: {path} - may be corrupted",
                 color=bcolors.YELLOW)
+            return None
+
+        return path
+
+    def getTileLayerFromCache(
+            self, z: int, x: int, y: int,
+            mapId: str,
+            tileConf: 'BaseTileSetConfig',
+            tileServerConf: BaseTileServerConfig) -> Tuple[Optional[Image], Optional[str]]:
+        path = self.getFreshTileLayerCachePath(
+            z, x, y, mapId, tileConf, tileServerConf)
+        if path is None:
             return None, None
 
+        # No lock is needed to read the cached tiles, as they are written
+        # atomically (see saveBlobAtomically)
         try:
-            with NamespaceLock(path):
-                return Image(filename=path), path
+            with open(path, "rb") as f:
+                markCacheFileUsed(f.fileno(), os.fstat(f.fileno()))
+                return Image(file=f), path
+        except FileNotFoundError:
+            pass
         except wand.exceptions.BlobError:
             pass
         return None, None
 
+    def getCachedTilePath(self, z: int, x: int, y: int,
+                          mapId: str,
+                          tileConf: 'BaseTileSetConfig') -> Optional[str]:
+        # Returns the path of a fresh cached tile that can be sent to the
+        # client as it is, or None if the tile has to go through
+        # downloadTileBlob. Providers that cache complete tiles can
+        # override this to let the server send the file without reading it.
+        return None
+
     @abstractmethod
     def downloadTile(self, z: int, x: int, y: int,
                      mapId: str,
@@ -165,20 +383,48 @@ class BaseDownloadProvider(ABC):
 
     def downloadTileBlob(self, z: int, x: int, y: int,
                          mapId: str,
-                         tileConf: 'BaseTileSetConfig') -> bytes():
+                         tileConf: 'BaseTileSetConfig') -> TileBlob:
+        # Returns the encoded tile
         image = self.downloadTile(z, x, y, mapId, tileConf)
+        return self._encodeTile(image, tileConf)
+
+    def _encodeTile(self, image: Image,
+                    tileConf: 'BaseTileSetConfig') -> TileBlob:
         if tileConf.filetype == ImageFileType.AUTO:
-            return image.make_blob()
-        return image.make_blob(format=tileConf.filetype.value)
+            return TileBlob(image.make_blob(), image.format.lower())
+        return TileBlob(image.make_blob(format=tileConf.filetype.value), tileConf.filetype.value)
 
 
 class MultithreadedDownloadProvider(BaseDownloadProvider):
     def __init__(
             self,
             numDownloadWorkers: int = 16,
-            downloadTimeoutSec: int = 3):
+            downloadTimeoutSec: int = 3,
+            memoryCacheMaxEntries: int = 2048,
+            prefetchNeighbourTiles: bool = False,
+            downloadDeadlineSec: float = 10):
         self._numDownloadWorkers = numDownloadWorkers
         self._downloadTimeoutSec = downloadTimeoutSec
+        self._downloadDeadlineSec = downloadDeadlineSec
+        # Prefetching multiplies the number of requests towards the tile
+        # servers, so only enable it for servers whose usage policy allows it
+        self._prefetchNeighbourTiles = prefetchNeighbourTiles
+        self._pendingPrefetches = threading.BoundedSemaphore(32)
+        self._prefetchExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=4,
+            thread_name_prefix="tile-prefetch")
+        # Recently served tiles are kept in memory in front of the disk
+        # cache of the layers
+        self._memoryCache = LRUBlobCache(maxEntries=memoryCacheMaxEntries)
+        # Futures of the tiles that are being downloaded, keyed by
+        # (mapId, z, x, y)
+        self._inflight: Dict[Tuple[str, int, int, int], concurrent.futures.Future] = {}
+        self._inflightLock = threading.Lock()
+        # The download workers are kept around and shared by all the tile
+        # requests, instead of starting new threads for every tile
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=numDownloadWorkers,
+            thread_name_prefix="tile-download")
         super(MultithreadedDownloadProvider, self).__init__()
 
     @property
@@ -188,6 +434,12 @@ class MultithreadedDownloadProvider(BaseDownloadProvider):
     @numDownloadWorkers.setter
     def numDownloadWorkers(self, numDownloadWorkers: int):
         self._numDownloadWorkers = numDownloadWorkers
+        oldExecutor = self._executor
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=numDownloadWorkers,
+            thread_name_prefix="tile-download")
+        # Let any running downloads finish in the background
+        oldExecutor.shutdown(wait=False)
 
     @property
     def downloadTimeoutSec(self) -> int:
@@ -201,17 +453,11 @@ class MultithreadedDownloadProvider(BaseDownloadProvider):
                               mapId: str,
                               tileConf: 'BaseTileSetConfig',
                               tileServerConf: BaseTileServerConfig) -> str:
-        firstServer = tileServerConf.servers[0]
-        urlFmt = tileServerConf.urlFmt
-        hashCalc = hashlib.blake2b(digest_size=8)
-        hashCalc.update(f"{firstServer}{urlFmt}".encode())
-        cacheDir = os.path.join(
+        cacheFile = os.path.join(
             self._tileCacheBasePath, mapId,
-            hashCalc.hexdigest(),
-            str(z), str(x)
+            _getTileServerHash(tileServerConf.servers[0], tileServerConf.urlFmt),
+            str(z), str(x), str(y)
         )
-        os.makedirs(cacheDir, exist_ok=True)
-        cacheFile = os.path.join(cacheDir, str(y))
         return cacheFile
 
     def _getTileUrlFromServerConf(self, z: int, x: int, y: int,
@@ -224,78 +470,350 @@ class MultithreadedDownloadProvider(BaseDownloadProvider):
         # the return value is the url that will be used to download the x/y tile
         # for zoom z.
         if tileServerConf.dynUrl is True:
-            exec(tileServerConf.servers[0], globals())
-            return dynGetTileUrl(z, x, y)  # noqa
-
-        serverIdx = randint(0, len(tileServerConf.servers) - 1)
-        return tileServerConf.protocol.value + "://" + tileServerConf.servers[
-            serverIdx] + "/" + tileServerConf.urlFmt.format(z=z, x=x, y=y)
+            return _compileDynGetTileUrl(tileServerConf.servers[0])(z, x, y)
+
+        servers = tuple(tileServerConf.servers)
+        urlTemplates = _getUrlTemplateCycle(
+            tileServerConf.protocol.value, servers, tileServerConf.urlFmt)
+        # Skip the servers that failed recently (see HostHealth). If all
+        # of them did, the next server in the cycle is tried anyway.
+        for _ in range(len(servers)):
+            server, urlTemplate = next(urlTemplates)
+            if defaultConnectionPool.hostHealth.isHealthy(server):
+                break
+        return urlTemplate.format(z=z, x=x, y=y)
 
     def _downloadTileLayers(self, urls: Dict[int, str], headers: Dict[int, Optional[Dict[Key, Value]]]) -> Dict[
-            int, Dict[str, Union[str, Image]]]:
+            int, Dict[str, Union[str, bytes, Image]]]:
         # Downloads tiles in parallel threads, and returns the download result in
         # a dict where the key is an integer. The key indicates the layering order
         # when making image composites later on, whereas the result with key 0 is
         # the base image, and any subsequent image is an overlay image
 
-        def downloadSingleTileLayer(url: str, headers: Optional[Dict[Key, Value]]):
-            # Downloads a tile from the url and returns the received bytes
-            req = urllib.request.Request(url)
-            if headers is not None:
-                for k, v in headers.items():
-                    req.add_header(k, v)
-
-            with urllib.request.urlopen(req, timeout=self._downloadTimeoutSec) as conn:
-                return conn.read()
+        def downloadSingleTileLayer(url: str, headers: Optional[Dict[Key, Value]]) -> Tuple[bytes, Image]:
+            # Downloads a tile from the url and returns the received bytes,
+            # and the decoded image. The connections to the tile servers are
+            # kept alive and reused across the tile requests. The layers are
+            # decoded by the download workers as soon as each one arrives,
+            # while the rest of the layers are still being downloaded.
+            data = defaultConnectionPool.fetch(
+                url, headers=headers, timeout=self._downloadTimeoutSec)
+            return data, Image(blob=data)
 
         images = {}
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self._numDownloadWorkers) as executor:
-            # Start the download operations and mark each future with its URL
-            futureToUrl = {
-                executor.submit(
-                    downloadSingleTileLayer,
-                    url=url, headers=headers[urlIdx]): (url, urlIdx) for urlIdx, url in urls.items()}
-
-            for future in concurrent.futures.as_completed(futureToUrl):
-                url, urlIdx = futureToUrl[future]
-                try:
-                    data = future.result()
-                except Exception as exc:
-                    printColor(
-                        f"{url} generated an exception: {exc}",
-                        color=bcolors.RED)
-                    return {}
-                else:
-                    printColor(
-                        f"Downloaded {url} - {len(data)} bytes",
-                        color=bcolors.CYAN)
-                    images[urlIdx] = {"url": url, "image": Image(blob=data)}
-        return images
+        # Start the download operations and mark each future with its URL
+        futureToUrl = {
+            self._executor.submit(
+                downloadSingleTileLayer,
+                url=url, headers=headers[urlIdx]): (url, urlIdx) for urlIdx, url in urls.items()}
+
+        def cancelPendingDownloads():
+            # Downloads that haven't started yet are dropped - there is no
+            # point in downloading the rest of the layers of a failed tile
+            for future in futureToUrl:
+                future.cancel()
+            for layer in images.values():
+                layer["image"].close()
+
+        # The socket timeout bounds each read, but not the total time a
+        # download takes (or waits for a free download worker). Bound the
+        # total time spent for all the layers of the tile too. Only the
+        # wait for the next download is guarded for the deadline, as the
+        # errors of the layers can be timeouts too.
+        completed = concurrent.futures.as_completed(
+            futureToUrl, timeout=self._downloadDeadlineSec)
+        while True:
+            try:
+                future = next(completed)
+            except StopIteration:
+                return images
+            except concurrent.futures.TimeoutError:
+                cancelPendingDownloads()
+                raise TimeoutError(
+                    f"Downloading the tile layers took more than {self._downloadDeadlineSec} seconds - giving up") from None
+
+            url, urlIdx = futureToUrl[future]
+            try:
+                data, image = future.result()
+            except Exception as exc:
+                # Raise the error of the first failed layer, so that the
+                # server can tell timeouts and tile server errors apart
+                printColor(
+                    f"{url} generated an exception: {exc}",
+                    color=bcolors.RED)
+                cancelPendingDownloads()
+                raise
+            printVerbose(
+                f"Downloaded {url} - {len(data)} bytes",
+                color=bcolors.CYAN)
+            images[urlIdx] = {
+                "url": url, "data": data, "image": image}
 
     def _makeCompositeFromLayers(self, layers: List[Image]) -> Image:
-        base = layers[0]
-        if len(layers) == 1:
-            return base
+        return buildCompositeFromLayers(layers)
+
+    def _canServeBlobAsIs(self, blob: bytes,
+                          tileConf: 'BaseTileSetConfig') -> Optional[str]:
+        # Returns the image format of the blob if the blob can be sent to
+        # the client as it is, or None if it has to be re-encoded
+        imageFormat = getImageFormatFromBlob(blob)
+        if imageFormat is None:
+            return None
+        if tileConf.filetype != ImageFileType.AUTO and tileConf.filetype.value != imageFormat:
+            return None
+        return imageFormat
+
+    def getCachedTilePath(self, z: int, x: int, y: int,
+                          mapId: str,
+                          tileConf: 'BaseTileSetConfig') -> Optional[str]:
+        # Tiles with a single layer are cached as they were downloaded,
+        # so the cached layer can be sent to the client as it is. Tiles
+        # that are kept in memory are served from memory by
+        # downloadTileBlob instead.
+        if len(tileConf.tileServers) != 1:
+            return None
+        if self._memoryCache.get((mapId, z, x, y)) is not None:
+            return None
+
+        path = self.getFreshTileLayerCachePath(
+            z, x, y, mapId, tileConf, tileConf.tileServers[0])
+        if path is None or tileConf.filetype == ImageFileType.AUTO:
+            return path
+
+        try:
+            with open(path, "rb") as f:
+                header = f.read(8)
+        except FileNotFoundError:
+            return None
+        if self._canServeBlobAsIs(header, tileConf) is None:
+            return None
+        return path
+
+    def _getMemoryCacheTimeoutSec(self, tileConf: 'BaseTileSetConfig') -> Optional[int]:
+        # Tiles are kept in memory as long as the layer with the shortest
+        # cache timeout. Tiles with a layer that must not be cached are
+        # not kept in memory either.
+        if not all(tileServerConf.enableTileCache for tileServerConf in tileConf.tileServers):
+            return None
+        return min(tileServerConf.tileCacheTimeoutSec for tileServerConf in tileConf.tileServers)
+
+    def _getTileExpiryTime(self, z: int, x: int, y: int,
+                           mapId: str,
+                           tileConf: 'BaseTileSetConfig',
+                           cacheTimeoutSec: int) -> float:
+        # A tile kept in memory expires together with the oldest of its
+        # layers in the disk cache, and not cacheTimeoutSec after it was
+        # read from the disk, so that it isn't served for longer than the
+        # cached layers it was made of
+        expiresAt = time.time() + cacheTimeoutSec
+        for tileServerConf in tileConf.tileServers:
+            path = self.getTileLayerCachePath(
+                z, x, y, mapId, tileConf, tileServerConf)
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            expiresAt = min(expiresAt, mtime + tileServerConf.tileCacheTimeoutSec)
+        return expiresAt
 
-        for i in range(1, len(layers)):
-            overlay = layers[i]
-            base = buildCompositeImage(base, overlay)
+    def downloadTileBlob(self, z: int, x: int, y: int,
+                         mapId: str,
+                         tileConf: 'BaseTileSetConfig') -> TileBlob:
+        # Hot tiles are served from memory, without any filesystem access,
+        # image decoding or compositing
+        key = (mapId, z, x, y)
+        cacheTimeoutSec = self._getMemoryCacheTimeoutSec(tileConf)
+        if cacheTimeoutSec is not None:
+            entry = self._memoryCache.getWithETag(key)
+            if entry is not None:
+                blob, etag = entry
+                imageFormat = getImageFormatFromBlob(blob)
+                if imageFormat is not None:
+                    printVerbose(
+                        f"Tile fetched from memory: {mapId}/{z}/{x}/{y}",
+                        color=bcolors.GREEN)
+                    return TileBlob(blob, imageFormat, etag)
+
+            if self._prefetchNeighbourTiles:
+                self._prefetchNeighbours(z, x, y, mapId, tileConf)
+
+        return self._getTileBlob(key, cacheTimeoutSec, z, x, y, mapId, tileConf)
+
+    def _getTileBlob(self, key: Tuple[str, int, int, int],
+                     cacheTimeoutSec: Optional[int],
+                     z: int, x: int, y: int,
+                     mapId: str,
+                     tileConf: 'BaseTileSetConfig') -> TileBlob:
+        tileBlob = self._downloadTileBlobOnce(
+            key, z, x, y, mapId, tileConf)
+        if cacheTimeoutSec is not None and getImageFormatFromBlob(tileBlob.data) is not None:
+            self._memoryCache.put(
+                key, tileBlob.data,
+                self._getTileExpiryTime(z, x, y, mapId, tileConf, cacheTimeoutSec),
+                tileBlob.etag)
+        return tileBlob
+
+    def _isTileCached(self, z: int, x: int, y: int,
+                      mapId: str,
+                      tileConf: 'BaseTileSetConfig') -> bool:
+        if self._memoryCache.get((mapId, z, x, y)) is not None:
+            return True
+        return all(
+            self.getFreshTileLayerCachePath(
+                z, x, y, mapId, tileConf, tileServerConf) is not None
+            for tileServerConf in tileConf.tileServers)
+
+    def _prefetchNeighbours(self, z: int, x: int, y: int,
+                            mapId: str,
+                            tileConf: 'BaseTileSetConfig'):
+        # Map clients request tiles in spatial bursts while panning, so the
+        # neighbours of a tile that is not in memory are likely to be
+        # requested next. Download them in the background, so that they are
+        # in the cache by the time they are requested. Prefetching is best
+        # effort: when too many prefetches are pending, the new ones are
+        # dropped, so that they never pile up behind the real requests.
+        numTiles = 1 << z
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                nx = x + dx
+                ny = y + dy
+                if (dx, dy) == (0, 0) or not (0 <= nx < numTiles and 0 <= ny < numTiles):
+                    continue
+                if not self._pendingPrefetches.acquire(blocking=False):
+                    return
+                self._prefetchExecutor.submit(
+                    self._prefetchTile, nx, ny, z, mapId, tileConf)
+
+    def _prefetchTile(self, x: int, y: int, z: int,
+                      mapId: str,
+                      tileConf: 'BaseTileSetConfig'):
+        try:
+            if self._isTileCached(z, x, y, mapId, tileConf):
+                return
+            printVerbose(
+                f"Prefetching tile {mapId}/{z}/{x}/{y}",
+                color=bcolors.CYAN)
+            self._getTileBlob(
+                (mapId, z, x, y), self._getMemoryCacheTimeoutSec(tileConf),
+                z, x, y, mapId, tileConf)
+        except Exception as exc:
+            printColor(
+                f"Prefetching tile {mapId}/{z}/{x}/{y} failed: {exc}",
+                color=bcolors.YELLOW)
+        finally:
+            self._pendingPrefetches.release()
 
-        return base
+    def _downloadTileBlobOnce(self, key: Tuple[str, int, int, int],
+                              z: int, x: int, y: int,
+                              mapId: str,
+                              tileConf: 'BaseTileSetConfig') -> TileBlob:
+        # Coalesce concurrent requests for the same tile: the first request
+        # downloads the tile and the rest wait for its result, instead of
+        # downloading and caching the same tile several times
+        with self._inflightLock:
+            future = self._inflight.get(key)
+            isOwner = future is None
+            if isOwner:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+
+        if not isOwner:
+            printVerbose(
+                f"Waiting for the in-flight request of {mapId}/{z}/{x}/{y}",
+                color=bcolors.BROWN)
+            return future.result()
+
+        try:
+            result = self._downloadTileBlob(z, x, y, mapId, tileConf)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflightLock:
+                del self._inflight[key]
+
+    def _downloadTileBlob(self, z: int, x: int, y: int,
+                          mapId: str,
+                          tileConf: 'BaseTileSetConfig') -> TileBlob:
+        # Tiles with a single layer don't need a composite. Serve the layer
+        # as it was downloaded (or cached), without decoding and
+        # re-encoding it, unless it has to be converted to another format.
+        if len(tileConf.tileServers) != 1:
+            return super(MultithreadedDownloadProvider, self).downloadTileBlob(
+                z, x, y, mapId, tileConf)
+
+        tileServerConf = tileConf.tileServers[0]
+        blob = None
+        etag = None
+        cachePath = self.getFreshTileLayerCachePath(
+            z, x, y, mapId, tileConf, tileServerConf)
+        if cachePath is not None:
+            try:
+                with open(cachePath, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    markCacheFileUsed(f.fileno(), st)
+                    etag = getTileETag(st)
+                    blob = f.read()
+                printVerbose(
+                    f"Loaded tile layer from cache: {cachePath}",
+                    color=bcolors.GREEN)
+            except FileNotFoundError:
+                pass
+
+        newCachePath = None
+        if not blob:
+            etag = None
+            url = self._getTileUrlFromServerConf(
+                z, x, y, mapId, tileConf, tileServerConf)
+            blob = defaultConnectionPool.fetch(
+                url, headers=tileServerConf.headers,
+                timeout=self._downloadTimeoutSec)
+            printVerbose(
+                f"Downloaded {url} - {len(blob)} bytes",
+                color=bcolors.CYAN)
+            if tileServerConf.enableTileCache:
+                newCachePath = self.getTileLayerCachePath(
+                    z, x, y, mapId, tileConf, tileServerConf)
+
+        imageFormat = self._canServeBlobAsIs(blob, tileConf)
+        if imageFormat is not None:
+            if newCachePath is not None:
+                printVerbose(
+                    f"Saving tile layer in cache: {newCachePath}")
+                etag = getTileETag(saveBlobAtomically(blob, newCachePath))
+            return TileBlob(blob, imageFormat, etag)
+
+        # Decoding the tile raises an error if the server did not return
+        # an image, so nothing invalid ends up in the cache
+        with Image(blob=blob) as image:
+            if newCachePath is not None:
+                printVerbose(
+                    f"Saving tile layer in cache: {newCachePath}")
+                saveImageAtomically(image, newCachePath)
+            return self._encodeTile(image, tileConf)
 
     def _loadLayersFromCache(self, z: int, x: int, y: int,
                              mapId: str,
                              tileConf: 'BaseTileSetConfig') -> Dict[
             int, Dict[str, Union[str, Image]]]:
         cachedLayers = {}
-        for layerIdx, tileServerConf in enumerate(tileConf.tileServers):
-            if not tileServerConf.enableTileCache:
-                continue
-            layer, cachePath = self.getTileLayerFromCache(
-                z, x, y, mapId, tileConf, tileServerConf)
+        # Load the cached layers in parallel. Most of the time is spent
+        # decoding the layers in image magick, which releases the GIL.
+        futureToLayerIdx = {
+            self._executor.submit(
+                self.getTileLayerFromCache,
+                z, x, y, mapId, tileConf, tileServerConf): layerIdx
+            for layerIdx, tileServerConf in enumerate(tileConf.tileServers)
+            if tileServerConf.enableTileCache}
+
+        for future in concurrent.futures.as_completed(futureToLayerIdx):
+            layerIdx = futureToLayerIdx[future]
+            layer, cachePath = future.result()
             if layer is None:
                 continue
-            printColor(
+            printVerbose(
                 f"Loaded tile layer from cache: {cachePath}",
                 color=bcolors.GREEN)
             cachedLayers[layerIdx] = {
@@ -328,15 +846,24 @@ class MultithreadedDownloadProvider(BaseDownloadProvider):
                 # enabled
                 cachePath = self.getTileLayerCachePath(
                     z, x, y, mapId, tileConf, tileServerConf)
-                print(
-                    f"Saving tile layer in cache: {cachePath}",
-                    file=sys.stderr)
-                with NamespaceLock(cachePath):
-                    layer["image"].save(filename=cachePath)
+                printVerbose(
+                    f"Saving tile layer in cache: {cachePath}")
+                # PNG and JPEG layers are cached as they were downloaded,
+                # without encoding the decoded layer again
+                if getImageFormatFromBlob(layer["data"]) is not None:
+                    saveBlobAtomically(layer["data"], cachePath)
+                else:
+                    saveImageAtomically(layer["image"], cachePath)
 
         allLayers = {**cachedLayers, **downloadedLayers}
-        tile = self._makeCompositeFromLayers(
-            [allLayers[i]["image"] for i in range(len(allLayers.keys()))])
+        if len(allLayers) != len(tileConf.tileServers):
+            raise TileDownloadError(
+                f"failed to get all the layers of tile {mapId}/{z}/{x}/{y}")
+        layers = [allLayers[i]["image"] for i in range(len(allLayers.keys()))]
+        tile = self._makeCompositeFromLayers(layers)
+        # Release the overlays that have been composited on the base layer
+        for layer in layers[1:]:
+            layer.close()
 
         return tile
 
@@ -1,25 +1,47 @@
 #!/usr/bin/env python3
 
+import hashlib
 import os
+import re
 import traceback
+import urllib.error
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from typing import Tuple
+from typing import Optional, Tuple
 
 from geonorge_provider import (
     GeonorgeCustomConfig,
     GeonorgeDatasetID,
     GeonorgeWMSDownloadProvider,
-    default_CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS
+    default_CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS,
+    default_CONCURRENT_GEONORGE_WMS_REQUESTS,
+    default_GEONORGE_WMS_MIN_REQUEST_INTERVAL_SEC
 )
 from nslock import getListOfActiveLocks
 from providers import (
     BaseTileServerConfig,
     BaseTileSetConfig,
-    ImageFileType,
     MainConfig,
+    TileBlob,
+    TileDownloadError,
     bcolors,
-    printColor
+    getImageFormatFromBlob,
+    getTileCacheBasePath,
+    getTileETag,
+    printColor,
+    printVerbose,
+    verboseLogging
 )
+from tilecache import (
+    DiskCacheEvictor,
+    default_TILE_CACHE_EVICTION_INTERVAL_SEC,
+    default_TILE_CACHE_MAX_BYTES,
+    markCacheFileUsed
+)
+
+# The clients (browsers, caching proxies, CDNs) may reuse the served tiles
+# for TILE_HTTP_MAX_AGE_SEC seconds without asking the proxy again, and
+# revalidate them with If-None-Match afterwards
+default_TILE_HTTP_MAX_AGE_SEC = 86400
 
 # A brief explanation of the map configuration format of the tile proxy
 # server follows.
@@ -86,7 +108,7 @@ mainConf = MainConfig(
                     'Sec-Fetch-Mode': 'cors',
                     'Sec-Fetch-Site': 'cross-site',
                     'Connection': 'keep-alive',
-                    'Accept-Encoding': 'gzip, deflate, br, zstd',
+                    'Accept-Encoding': 'gzip, deflate',
                     'TE': 'trailers',
                 }
             ),
@@ -144,25 +166,36 @@ mainConf = MainConfig(
                 dynUrl=True,
                 servers=[
                     """
-import urllib
+import functools
+import urllib.parse
 import mercantile
+
+# This code is executed only once, so anything that doesn't depend on the
+# requested tile is computed here. Only the bounding box changes between
+# the tiles.
+url = 'https://avigis.avinor.no/agsmap/rest/services/ICAO_500000/MapServer/export?'
+urlPrefix = url + urllib.parse.urlencode({
+    "f": "image",
+    "format": "png32",
+    "transparent": "true",
+    "layers": "show:3",
+}) + "&bbox="
+urlSuffix = "&" + urllib.parse.urlencode({
+    "bboxSR": 4326, # WGS 84: https://developers.arcgis.com/rest/services-reference/enterprise/export-image.htm
+    # Web Mercator (3857):
+    # https://developers.arcgis.com/rest/services-reference/enterprise/export-image.htm
+    "imageSR": 3857,
+    "size": "256,256",
+})
+
+# Use mercantile to find the bounding box, and remember the bounding
+# boxes of the recently requested tiles
+tileBounds = functools.lru_cache(maxsize=16384)(mercantile.bounds)
+
 def dynGetTileUrl(z, x, y):
-    url = 'https://avigis.avinor.no/agsmap/rest/services/ICAO_500000/MapServer/export?'
-    # Use mercantile to find the bounding box
-    bbox = mercantile.bounds(x, y, z)
-    params = {
-        "f": "image",
-        "format": "png32",
-        "transparent": "true",
-        "layers": "show:3",
-        "bbox": "{},{},{},{}".format(bbox.west, bbox.south, bbox.east, bbox.north),
-        "bboxSR": 4326, # WGS 84: https://developers.arcgis.com/rest/services-reference/enterprise/export-image.htm
-        # Web Mercator (3857):
-        # https://developers.arcgis.com/rest/services-reference/enterprise/export-image.htm
-        "imageSR": 3857,
-        "size": "256,256",
-    }
-    return url + urllib.parse.urlencode(params)
+    bbox = tileBounds(x, y, z)
+    return urlPrefix + urllib.parse.quote_plus(
+        f"{bbox.west},{bbox.south},{bbox.east},{bbox.north}") + urlSuffix
 """,
                 ],
             ),
@@ -435,98 +468,255 @@ def dynGetTileUrl(z, x, y):
 
 hostName = os.environ.get("BIND_ADDR", "0.0.0.0")
 serverPort = int(os.environ.get("BIND_PORT", 8080))
+# The disk cache is bounded to TILE_CACHE_MAX_BYTES when set to a value
+# larger than 0
+tileCacheMaxBytes = int(os.environ.get(
+    "TILE_CACHE_MAX_BYTES", default_TILE_CACHE_MAX_BYTES))
+tileCacheEvictionIntervalSec = float(os.environ.get(
+    "TILE_CACHE_EVICTION_INTERVAL_SEC",
+    default_TILE_CACHE_EVICTION_INTERVAL_SEC))
+tileHttpMaxAgeSec = int(os.environ.get(
+    "TILE_HTTP_MAX_AGE_SEC", default_TILE_HTTP_MAX_AGE_SEC))
+tileCacheControl = f"public, max-age={tileHttpMaxAgeSec}"
+# The tile requests look like /map_identifier/z/x/y, optionally followed
+# by more path elements or a query string that are ignored
+tilePathRe = re.compile(r"/*([^/]+)/(\d+)/(\d+)/(\d+)(?:[/?].*)?")
+# The settings don't change while the server is running, so the /settings
+# response is only built once
+concurrentGeonorgeLargeDownloads = os.environ.get(
+    "CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS",
+    default_CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS)
+concurrentGeonorgeWMSRequests = os.environ.get(
+    "CONCURRENT_GEONORGE_WMS_REQUESTS",
+    default_CONCURRENT_GEONORGE_WMS_REQUESTS)
+geonorgeWMSMinRequestIntervalSec = os.environ.get(
+    "GEONORGE_WMS_MIN_REQUEST_INTERVAL_SEC",
+    default_GEONORGE_WMS_MIN_REQUEST_INTERVAL_SEC)
+settingsBody = (
+    f"CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS={concurrentGeonorgeLargeDownloads}\n"
+    f"CONCURRENT_GEONORGE_WMS_REQUESTS={concurrentGeonorgeWMSRequests}\n"
+    f"GEONORGE_WMS_MIN_REQUEST_INTERVAL_SEC={geonorgeWMSMinRequestIntervalSec}\n"
+    f"TILE_CACHE_MAX_BYTES={tileCacheMaxBytes}\n"
+    f"TILE_CACHE_EVICTION_INTERVAL_SEC={tileCacheEvictionIntervalSec}\n"
+    f"TILE_HTTP_MAX_AGE_SEC={tileHttpMaxAgeSec}\n"
+    f"VERBOSE_LOGGING={int(verboseLogging)}").encode()
 
 
 class HttpRequestHandler(BaseHTTPRequestHandler):
-    def getTileSetConfFromUrl(self) -> Tuple[int, int, int, BaseTileSetConfig]:
+    # Keep the client connections alive between the tile requests, so that
+    # the clients don't need a new TCP connection for every tile. All the
+    # responses carry a Content-Length header for that. Idle connections
+    # are closed after a while, to not hold server threads forever.
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+    # Buffer the responses, so that the headers and small bodies are sent
+    # with a single write, and don't let Nagle's algorithm delay the last
+    # segment of a response on a kept alive connection
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        # Only log every request when the verbose logging is enabled. The
+        # errors are logged through log_error() that is not affected.
+        if verboseLogging:
+            super().log_message(format, *args)
+
+    def log_error(self, format, *args):
+        super().log_message(format, *args)
+
+    def getTileSetConfFromUrl(self) -> Tuple[int, int, int, str, BaseTileSetConfig]:
         # Always expect a url in the form of /map_identifier/z/x/y
-        data = self.path.rstrip('/').lstrip('/').split('/')
-        if len(data) < 4:
+        match = tilePathRe.fullmatch(self.path)
+        if match is None:
             raise ValueError(
                 "Error: expecting GET request in the form 'map_config/z/x/y'")
 
-        mapId = data[0]
+        mapId, z, x, y = match.groups()
         mapConf = mainConf.get(mapId, None)
         if mapConf is None:
             raise IndexError(
-                f"Error: no map '{data[0]}' found in the tile proxy conf")
+                f"Error: no map '{mapId}' found in the tile proxy conf")
+
+        return int(z), int(x), int(y), mapId, mapConf
+
+    def sendBody(self, contentType: str, body: bytes):
+        self.send_response(200)
+        self.send_header("Content-type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
-        z = int(data[1])
-        x = int(data[2])
-        y = int(data[3])
+    def isNotModified(self, etag: str) -> bool:
+        # Returns True if the client already has the tile with the given
+        # ETag, in which case a 304 is sent instead of the tile
+        ifNoneMatch = self.headers.get("If-None-Match")
+        if ifNoneMatch is None:
+            return False
+        clientEtags = [tag.strip() for tag in ifNoneMatch.split(",")]
+        if "*" not in clientEtags and etag not in clientEtags and f"W/{etag}" not in clientEtags:
+            return False
 
-        return z, x, y, mapId, mapConf
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", tileCacheControl)
+        self.end_headers()
+        printVerbose(
+            f" - Tile {self.path} not modified",
+            color=bcolors.BOLD + bcolors.BLUE)
+        return True
+
+    def sendTileHeaders(self, contentType: str, size: int, etag: str):
+        self.send_response(200)
+        self.send_header("Content-type", contentType)
+        self.send_header("Content-Length", str(size))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", tileCacheControl)
+        self.end_headers()
+
+    def sendTile(self, contentType: str, body: bytes, etag: Optional[str] = None):
+        # Tiles that are not stored as they are in a cache file (e.g. the
+        # composites of several layers) get an ETag from their content
+        if etag is None:
+            etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        if self.isNotModified(etag):
+            return
+        self.sendTileHeaders(contentType, len(body), etag)
+        self.wfile.write(body)
 
     def parseFirstLevelPaths(self, path: str) -> bool:
         if path == "/favicon.ico":
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
+            # There is no favicon. Let the browsers remember that, so that
+            # they don't ask again for every page load.
+            self.send_response(204)
+            self.send_header("Cache-Control", "public, max-age=31536000, immutable")
             self.end_headers()
-            self.wfile.write(b'')
             return True
         elif path == "/locks":
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(
+            self.sendBody(
+                "text/plain",
                 getListOfActiveLocks(
                     return_str=True,
                     sorted_by_refcount=False).encode())
             return True
         elif path == "/locks-sorted":
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(
+            self.sendBody(
+                "text/plain",
                 getListOfActiveLocks(
                     return_str=True,
                     sorted_by_refcount=True).encode())
             return True
         elif path == "/settings":
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-
-            concurrentGeonorgeLargeDownloads = str(os.environ.get(
-                "CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS",
-                default_CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS))
-            self.wfile.write(f"CONCURRENT_GEONORGE_LARGE_TILE_DOWNLOADS={concurrentGeonorgeLargeDownloads}".encode())
+            self.sendBody("text/plain", settingsBody)
             return True
         # Request hasn't been served yet - return False
         return False
 
+    def sendCachedTile(self, path: str) -> bool:
+        # Send a cached tile file to the client with sendfile(), so that the
+        # tile is copied from the page cache to the socket by the kernel.
+        # Returns False if the file is gone or is not an image we know.
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return False
+
+        with f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            image_type = getImageFormatFromBlob(os.pread(f.fileno(), 8, 0))
+            if image_type is None:
+                return False
+
+            markCacheFileUsed(f.fileno(), st)
+            etag = getTileETag(st)
+            if self.isNotModified(etag):
+                return True
+
+            self.sendTileHeaders(f"image/{image_type}", size, etag)
+            # The headers are buffered - send them before the file
+            self.wfile.flush()
+            printVerbose(
+                f" - Serving cached tile {self.path} from {path}",
+                color=bcolors.BOLD + bcolors.BLUE)
+            self.connection.sendfile(f, offset=0, count=size)
+        return True
+
     def do_GET(self):
-        printColor(
+        printVerbose(
             f" - Serving Incoming request {bcolors.BOLD}{self.path}",
             color=bcolors.PURPLE)
         if self.parseFirstLevelPaths(path=self.path):
             return
 
+        # Malformed requests and unknown maps are the client's fault, and
+        # are answered without a traceback (send_error() logs them)
         try:
             z, x, y, mapId, mapConf = self.getTileSetConfFromUrl()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        except IndexError as e:
+            self.send_error(404, str(e))
+            return
 
-            image = mapConf.downloader.downloadTile(z, x, y, mapId, mapConf)
-            image_type = image.format
-            image_blob = (
-                image.make_blob() if (
-                    mapConf.filetype == ImageFileType.AUTO
-                ) else image.make_blob(mapConf.filetype)
-            )
+        try:
+            cachedTilePath = mapConf.downloader.getCachedTilePath(
+                z, x, y, mapId, mapConf)
+        except Exception:
+            # Download the tile if the cache can't be read
+            printColor(traceback.format_exc(), color=bcolors.RED)
+            cachedTilePath = None
 
-            self.send_response(200)
-            self.send_header("Content-type", f"image/{image_type}")
-            self.end_headers()
-            printColor(
+        # The errors that are raised here come from the client connection
+        # (the errors of the tile servers are handled by downloadTileBlob),
+        # and part of the response may have been sent already, so the
+        # connection is closed instead of sending an error response
+        try:
+            if cachedTilePath is not None and self.sendCachedTile(cachedTilePath):
+                return
+
+            tileBlob = self.downloadTileBlob(z, x, y, mapId, mapConf)
+            if tileBlob is None:
+                return
+
+            printVerbose(
                 f" - Serving tile {self.path}",
                 color=bcolors.BOLD + bcolors.BLUE)
-            self.wfile.write(image_blob)
-        except BrokenPipeError:
+            self.sendTile(f"image/{tileBlob.imageFormat}", tileBlob.data, tileBlob.etag)
+        except (BrokenPipeError, ConnectionResetError):
+            printColor(
+                "Connection closed by the client - won't respond to the client",
+                color=bcolors.RED)
+            self.close_connection = True
+        except TimeoutError:
             printColor(
-                "Broken pipe - won't respond to the client",
+                f"Timed out sending {self.path} to the client",
                 color=bcolors.RED)
-        except BaseException:
+            self.close_connection = True
+
+    def downloadTileBlob(self, z: int, x: int, y: int,
+                         mapId: str,
+                         mapConf: BaseTileSetConfig) -> Optional[TileBlob]:
+        # Returns the tile, or sends an error response and returns None if
+        # the tile couldn't be made. Nothing has been sent to the client
+        # yet at this point.
+        try:
+            return mapConf.downloader.downloadTileBlob(
+                z, x, y, mapId, mapConf)
+        except TimeoutError as e:
+            # The tile servers didn't respond in time
+            self.send_error(504, f"Timed out downloading the tile: {e}")
+        except urllib.error.HTTPError as e:
+            # A tile server responded with an error
+            self.send_error(502, f"Tile server error {e.code}: {e.url}")
+        except (OSError, TileDownloadError) as e:
+            # The tile servers couldn't be reached, or didn't return a
+            # valid tile after all the retries
+            self.send_error(502, f"Downloading the tile failed: {e}")
+        except Exception:
             printColor(traceback.format_exc(), color=bcolors.RED)
-            self.send_error(408)
+            self.send_error(500)
+        return None
 
 
 if __name__ == "__main__":
@@ -541,6 +731,14 @@ if __name__ == "__main__":
             f"* http://{hostName}:{serverPort}/{map_key}/z/x/y",
             color=bcolors.WHITE)
 
+    if tileCacheMaxBytes > 0:
+        printColor(
+            f"Tile cache limited to {tileCacheMaxBytes} bytes",
+            color=bcolors.WHITE)
+        DiskCacheEvictor(
+            getTileCacheBasePath(), tileCacheMaxBytes,
+            tileCacheEvictionIntervalSec).start()
+
     try:
         webServer.serve_forever()
     except KeyboardInterrupt:
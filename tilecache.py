@@ -0,0 +1,183 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock, Thread
+from typing import Hashable, List, Optional, Tuple
+
+# The disk cache is not bounded by default
+default_TILE_CACHE_MAX_BYTES = 0
+default_TILE_CACHE_EVICTION_INTERVAL_SEC = 600
+
+# The access time of a cache file that is read is updated by the proxy
+# itself (see markCacheFileUsed), at most once every
+# _ACCESS_TIME_RESOLUTION_SEC, to limit the metadata writes
+_ACCESS_TIME_RESOLUTION_SEC = 3600
+# Temporary files of the atomic cache writes that are older than this
+# were left behind by a crash, and are removed by the eviction
+_STALE_TEMP_FILE_SEC = 3600
+
+
+def markCacheFileUsed(fd: int, st: os.stat_result):
+    # The disk cache eviction removes the files with the oldest access
+    # time first, but the kernel doesn't update the access times on
+    # noatime mounts, and updates them at most once a day on relatime
+    # mounts (the default). So set the access time of the cache files
+    # when they are read. The modification time is kept, as it is the
+    # time the file was cached. The open file is updated rather than the
+    # path, as the path may have been replaced by a newer file meanwhile.
+    now = time.time()
+    if now - st.st_atime < _ACCESS_TIME_RESOLUTION_SEC:
+        return
+    try:
+        os.utime(fd, ns=(time.time_ns(), st.st_mtime_ns))
+    except (OSError, NotImplementedError):
+        pass
+
+
+class LRUBlobCache:
+    """
+    A bounded in-memory LRU cache of encoded tiles that sits in front of
+    the disk caches. Repeated requests for the same tile are served from
+    memory without any filesystem access or image decoding.
+
+    Each entry expires at the time given when it was added, so that the
+    tile cache timeouts of the disk cache are honored. An entry can also
+    carry the ETag of the cache file that the tile was read from.
+    """
+
+    def __init__(self, maxEntries: int = 1024, maxBytes: int = 64 * 1024 * 1024):
+        self._maxEntries = maxEntries
+        self._maxBytes = maxBytes
+        self._lock = Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[float, bytes, Optional[str]]]" = OrderedDict()
+        self._size = 0
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        entry = self.getWithETag(key)
+        if entry is None:
+            return None
+        return entry[0]
+
+    def getWithETag(self, key: Hashable) -> Optional[Tuple[bytes, Optional[str]]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expiresAt, blob, etag = entry
+            if time.time() > expiresAt:
+                del self._entries[key]
+                self._size -= len(blob)
+                return None
+            self._entries.move_to_end(key)
+            return blob, etag
+
+    def put(self, key: Hashable, blob: bytes, expiresAt: float,
+            etag: Optional[str] = None):
+        if len(blob) > self._maxBytes:
+            return
+        with self._lock:
+            oldEntry = self._entries.pop(key, None)
+            if oldEntry is not None:
+                self._size -= len(oldEntry[1])
+            self._entries[key] = (expiresAt, blob, etag)
+            self._size += len(blob)
+            while len(self._entries) > self._maxEntries or self._size > self._maxBytes:
+                _, (_, evictedBlob, _) = self._entries.popitem(last=False)
+                self._size -= len(evictedBlob)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+class DiskCacheEvictor:
+    """
+    Keeps the size of the disk cache under maxBytes. A background thread
+    periodically walks the cache directory and, when the cache is larger
+    than maxBytes, removes the files with the oldest access time until the
+    cache is below 90% of maxBytes, so that the eviction doesn't run again
+    as soon as the next tile is written. The providers update the access
+    time of the files they read (see markCacheFileUsed), so the eviction
+    order doesn't depend on the atime mount options, but a file is only
+    marked as used once an hour.
+    """
+
+    def __init__(self, basePath: str, maxBytes: int,
+                 intervalSec: float = default_TILE_CACHE_EVICTION_INTERVAL_SEC):
+        self._basePath = basePath
+        self._maxBytes = maxBytes
+        self._intervalSec = intervalSec
+
+    def _listCacheFiles(self) -> List[Tuple[float, int, str]]:
+        files = []
+        staleTempFileTime = time.time() - _STALE_TEMP_FILE_SEC
+        dirs = [self._basePath]
+        while dirs:
+            try:
+                entries = os.scandir(dirs.pop())
+            except FileNotFoundError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.path)
+                        elif not entry.is_file(follow_symlinks=False):
+                            continue
+                        elif not entry.name.startswith("."):
+                            st = entry.stat(follow_symlinks=False)
+                            files.append((st.st_atime, st.st_size, entry.path))
+                        elif entry.name.endswith(".tmp"):
+                            # Hidden files are temporary files of writes
+                            # in progress - leave them alone, unless a
+                            # crash left them behind
+                            if entry.stat(follow_symlinks=False).st_mtime < staleTempFileTime:
+                                os.unlink(entry.path)
+                    except FileNotFoundError:
+                        continue
+        return files
+
+    def evict(self) -> int:
+        # Returns the number of bytes removed from the cache
+        files = self._listCacheFiles()
+        totalBytes = sum(size for _, size, _ in files)
+        if totalBytes <= self._maxBytes:
+            return 0
+
+        targetBytes = self._maxBytes * 0.9
+        freedBytes = 0
+        files.sort()
+        for _, size, path in files:
+            if totalBytes - freedBytes <= targetBytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            freedBytes += size
+        return freedBytes
+
+    def _run(self):
+        # The providers import this module, so import the logging helpers
+        # only once the thread runs
+        from providers import bcolors, printColor
+
+        while True:
+            # Any error is logged and the eviction is tried again later, so
+            # that the thread never stops evicting for the life of the
+            # process
+            try:
+                freedBytes = self.evict()
+                if freedBytes:
+                    printColor(
+                        f"Evicted {freedBytes} bytes from the tile cache {self._basePath}",
+                        color=bcolors.BROWN)
+            except Exception as e:
+                printColor(
+                    f"Tile cache eviction failed: {e}",
+                    color=bcolors.RED)
+            time.sleep(self._intervalSec)
+
+    def start(self):
+        Thread(target=self._run, name="tile-cache-evictor", daemon=True).start()
@@ -0,0 +1,93 @@
+import itertools
+import threading
+import unittest
+from unittest import mock
+
+import geonorge_provider
+from geonorge_provider import _LargeTileAdmission
+
+
+class TestLargeTileAdmission(unittest.TestCase):
+    def _startWaiter(self, admission: _LargeTileAdmission, ns: str,
+                     admitted: list, release: threading.Event) -> threading.Thread:
+        def run():
+            with admission.admit(ns):
+                admitted.append(ns)
+                release.wait(5)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def _waitUntilWaiting(self, admission: _LargeTileAdmission, count: int):
+        with admission._cond:
+            self.assertTrue(admission._cond.wait_for(
+                lambda: len(admission._waiting) == count, timeout=5))
+
+    def test_most_requested_namespace_goes_first(self):
+        admission = _LargeTileAdmission(1)
+        admitted = []
+        release = threading.Event()
+        refcounts = {"a": 1, "b": 3}
+        with mock.patch.object(geonorge_provider, "getListOfActiveLocks", lambda: refcounts):
+            with admission.admit("holder"):
+                threads = [self._startWaiter(admission, ns, admitted, release)
+                           for ns in ("a", "b")]
+                self._waitUntilWaiting(admission, 2)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+        self.assertEqual(admitted, ["b", "a"])
+
+    def test_changing_refcounts_dont_stall_the_waiters(self):
+        # The refcounts flip every time they are read, so any waiter that
+        # ranks the others by itself sees a different winner every time
+        admission = _LargeTileAdmission(1)
+        admitted = []
+        release = threading.Event()
+        rankings = itertools.cycle([{"a": 2, "b": 1}, {"a": 1, "b": 2}])
+        with mock.patch.object(geonorge_provider, "getListOfActiveLocks", lambda: next(rankings)):
+            with admission.admit("holder"):
+                threads = [self._startWaiter(admission, ns, admitted, release)
+                           for ns in ("a", "b")]
+                self._waitUntilWaiting(admission, 2)
+            release.set()
+            for thread in threads:
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+        self.assertEqual(sorted(admitted), ["a", "b"])
+        self.assertEqual(admission._active, 0)
+
+
+class TestMakeTileOnce(unittest.TestCase):
+    def test_concurrent_requests_make_the_tile_once(self):
+        provider = geonorge_provider.GeonorgeWMSDownloadProvider()
+        tile = object()
+        started = threading.Event()
+        release = threading.Event()
+
+        def downloadAndCropTile(*args):
+            started.set()
+            release.wait(5)
+            return tile
+
+        results = []
+        with mock.patch.object(provider, "_getTileCompositeCachePath", lambda *args: "tile.png"), \
+                mock.patch.object(provider, "_downloadAndCropTile", side_effect=downloadAndCropTile) as made:
+            owner = threading.Thread(
+                target=lambda: results.append(provider._makeTileOnce(1, 0, 0, "map", None)))
+            owner.start()
+            self.assertTrue(started.wait(5))
+            waiter = threading.Thread(
+                target=lambda: results.append(provider._makeTileOnce(1, 0, 0, "map", None)))
+            waiter.start()
+            # The waiter blocks until the owner has made the tile
+            waiter.join(0.1)
+            self.assertTrue(waiter.is_alive())
+            release.set()
+            owner.join(5)
+            waiter.join(5)
+
+        self.assertEqual(made.call_count, 1)
+        self.assertCountEqual(results, [tile, None])
+        self.assertEqual(provider._inflight, {})
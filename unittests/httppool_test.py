@@ -0,0 +1,144 @@
+import gzip
+import os
+import threading
+import time
+import unittest
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from httppool import HostHealth, HTTPConnectionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    clientPorts = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        KeepAliveHandler.clientPorts.add(self.client_address[1])
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/tile")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path == "/accept-encoding":
+            body = self.headers.get("Accept-Encoding", "").encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path in ("/missing", "/unavailable"):
+            self.send_response(404 if self.path == "/missing" else 503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = self.path.encode()
+        self.send_response(200)
+        if self.path == "/gzip":
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestHTTPConnectionPool(unittest.TestCase):
+    def setUp(self):
+        KeepAliveHandler.clientPorts = set()
+        self._server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), KeepAliveHandler)
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self._baseUrl = f"http://127.0.0.1:{self._server.server_port}"
+        self._pool = HTTPConnectionPool()
+
+    def tearDown(self):
+        self._pool.clear()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def test_reuses_connection(self):
+        for i in range(5):
+            self.assertEqual(
+                self._pool.fetch(f"{self._baseUrl}/tile/{i}"),
+                f"/tile/{i}".encode())
+        self.assertEqual(len(KeepAliveHandler.clientPorts), 1)
+
+    def test_follows_redirects(self):
+        self.assertEqual(
+            self._pool.fetch(f"{self._baseUrl}/redirect"), b"/tile")
+
+    def test_raises_http_error(self):
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self._pool.fetch(f"{self._baseUrl}/missing")
+        self.assertEqual(ctx.exception.code, 404)
+
+    def test_decodes_gzip_responses(self):
+        data, headers = self._pool.fetchWithHeaders(f"{self._baseUrl}/gzip")
+        self.assertEqual(data, b"/gzip")
+        self.assertEqual(headers.get("Content-Type"), "image/png")
+
+    def test_only_advertises_decodable_encodings(self):
+        self.assertEqual(
+            self._pool.fetch(f"{self._baseUrl}/accept-encoding",
+                             headers={"Accept-Encoding": "gzip, deflate, br, zstd"}),
+            b"gzip, deflate")
+        self.assertEqual(
+            self._pool.fetch(f"{self._baseUrl}/accept-encoding",
+                             headers={"accept-encoding": "br"}),
+            b"identity")
+
+    def test_reports_host_health(self):
+        host = f"127.0.0.1:{self._server.server_port}"
+        with self.assertRaises(urllib.error.HTTPError):
+            self._pool.fetch(f"{self._baseUrl}/unavailable")
+        self.assertFalse(self._pool.hostHealth.isHealthy(host))
+        self._pool.fetch(f"{self._baseUrl}/tile")
+        self.assertTrue(self._pool.hostHealth.isHealthy(host))
+
+
+    def test_sends_absolute_urls_to_http_proxy(self):
+        # The test server echoes the request target, which is the absolute
+        # url of the tile when it is used as a proxy
+        pool = HTTPConnectionPool(proxies={"http": self._baseUrl})
+        try:
+            with mock.patch.dict(os.environ, {"no_proxy": ""}):
+                self.assertEqual(
+                    pool.fetch("http://tiles.invalid/tile"),
+                    b"http://tiles.invalid/tile")
+        finally:
+            pool.clear()
+
+    def test_bypasses_proxy_for_no_proxy_hosts(self):
+        pool = HTTPConnectionPool(proxies={"http": "http://127.0.0.1:9"})
+        try:
+            with mock.patch.dict(os.environ, {"no_proxy": "127.0.0.1"}):
+                self.assertEqual(
+                    pool.fetch(f"{self._baseUrl}/tile"), b"/tile")
+        finally:
+            pool.clear()
+
+
+class TestHostHealth(unittest.TestCase):
+    def test_backoff(self):
+        health = HostHealth(minBackoffSec=0.05, maxBackoffSec=0.1)
+        self.assertTrue(health.isHealthy("a"))
+        health.reportFailure("a")
+        self.assertFalse(health.isHealthy("a"))
+        self.assertTrue(health.isHealthy("b"))
+        time.sleep(0.06)
+        self.assertTrue(health.isHealthy("a"))
+        # The backoff doubles with every consecutive failure
+        health.reportFailure("a")
+        time.sleep(0.06)
+        self.assertFalse(health.isHealthy("a"))
+        health.reportSuccess("a")
+        self.assertTrue(health.isHealthy("a"))
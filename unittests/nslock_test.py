@@ -0,0 +1,41 @@
+import threading
+import unittest
+
+from nslock import NamespaceLock, getListOfActiveLocks
+
+
+class TestNamespaceLock(unittest.TestCase):
+    def test_lock_is_released_and_forgotten(self):
+        with NamespaceLock("ns-a"):
+            self.assertEqual(getListOfActiveLocks().get("ns-a"), 1)
+        self.assertNotIn("ns-a", getListOfActiveLocks())
+
+    def test_mutual_exclusion(self):
+        counter = {"value": 0}
+
+        def increment():
+            for _ in range(1000):
+                with NamespaceLock("ns-counter"):
+                    value = counter["value"]
+                    counter["value"] = value + 1
+
+        threads = [threading.Thread(target=increment) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(counter["value"], 8000)
+        self.assertNotIn("ns-counter", getListOfActiveLocks())
+
+    def test_sorted_by_refcount(self):
+        waiting = NamespaceLock("ns-waiting")
+        held = NamespaceLock("ns-held")
+        also_held = NamespaceLock("ns-held")
+        with waiting, held:
+            locks = getListOfActiveLocks(sorted_by_refcount=True)
+            self.assertEqual(list(locks.items())[:2], [("ns-held", 2), ("ns-waiting", 1)])
+            self.assertIn("ns-held (refcount 2)", getListOfActiveLocks(
+                return_str=True, sorted_by_refcount=True))
+        with also_held:
+            pass
+        self.assertEqual(getListOfActiveLocks(), {})
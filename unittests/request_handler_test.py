@@ -1,6 +1,19 @@
+import http.client
 import importlib
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO as IO
+from typing import Optional
+
+from providers import (
+    BaseTileServerConfig,
+    BaseTileSetConfig,
+    MultithreadedDownloadProvider,
+    TileServerProtocol
+)
 
 root = importlib.import_module("slippy-tile-proxy-server")
 
@@ -18,6 +31,12 @@ class MockRequest(object):
         self._path = path
         self._expect = expect_in_response
 
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
     def sendall(self, response):
         self._test.assertTrue(response.decode().find(self._expect))
 
@@ -38,4 +57,140 @@ class TestHttpRequestHandler(unittest.TestCase):
         return root.HttpRequestHandler(request, (0, 0), None)
 
     def test_parse_url(self):
-        self._test(MockRequest(test_caller=self, path="/", expect_in_response="Error code: 408"))
+        self._test(MockRequest(test_caller=self, path="/", expect_in_response="Error code: 400"))
+
+
+class FailingTileServerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/slow/"):
+            time.sleep(1)
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class TestCompositeTileErrors(unittest.TestCase):
+    def setUp(self):
+        self._upstream = ThreadingHTTPServer(
+            ("127.0.0.1", 0), FailingTileServerHandler)
+        self._proxy = ThreadingHTTPServer(
+            ("127.0.0.1", 0), root.HttpRequestHandler)
+        for server in (self._upstream, self._proxy):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        upstream = f"127.0.0.1:{self._upstream.server_port}"
+        downloader = MultithreadedDownloadProvider(downloadTimeoutSec=0.2)
+        for mapId, urlFmt in (("test_slow", "slow/{z}/{x}/{y}"),
+                              ("test_error", "error/{z}/{x}/{y}")):
+            root.mainConf[mapId] = BaseTileSetConfig(
+                downloader=downloader,
+                tileServers=[
+                    BaseTileServerConfig(
+                        servers=[upstream], urlFmt=urlFmt,
+                        protocol=TileServerProtocol.HTTP,
+                        enableTileCache=False)
+                    for _ in range(2)])
+
+        # Nothing listens on the port of a closed server
+        closedServer = ThreadingHTTPServer(("127.0.0.1", 0), FailingTileServerHandler)
+        closedServer.server_close()
+        root.mainConf["test_unreachable"] = BaseTileSetConfig(
+            downloader=downloader,
+            tileServers=[
+                BaseTileServerConfig(
+                    servers=[f"127.0.0.1:{closedServer.server_port}"],
+                    protocol=TileServerProtocol.HTTP,
+                    enableTileCache=False)
+                for _ in range(2)])
+
+    def tearDown(self):
+        for mapId in ("test_slow", "test_error", "test_unreachable"):
+            del root.mainConf[mapId]
+        for server in (self._upstream, self._proxy):
+            server.shutdown()
+            server.server_close()
+
+    def _getStatus(self, path: str) -> int:
+        conn = http.client.HTTPConnection("127.0.0.1", self._proxy.server_port)
+        try:
+            conn.request("GET", path)
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def test_composite_timeout_is_504(self):
+        self.assertEqual(self._getStatus("/test_slow/1/0/0"), 504)
+
+    def test_composite_tile_server_error_is_502(self):
+        self.assertEqual(self._getStatus("/test_error/1/0/0"), 502)
+
+    def test_unreachable_tile_server_is_502(self):
+        self.assertEqual(self._getStatus("/test_unreachable/1/0/0"), 502)
+
+
+class PngTileServerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    body = b"\x89PNG\r\n\x1a\n" + b"tile"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-type", "image/png")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+
+class TestTileETags(unittest.TestCase):
+    def setUp(self):
+        self._cacheDir = tempfile.TemporaryDirectory()
+        self._upstream = ThreadingHTTPServer(
+            ("127.0.0.1", 0), PngTileServerHandler)
+        self._proxy = ThreadingHTTPServer(
+            ("127.0.0.1", 0), root.HttpRequestHandler)
+        for server in (self._upstream, self._proxy):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        self._downloader = MultithreadedDownloadProvider()
+        self._downloader._tileCacheBasePath = self._cacheDir.name
+        root.mainConf["test_png"] = BaseTileSetConfig(
+            downloader=self._downloader,
+            tileServers=[
+                BaseTileServerConfig(
+                    servers=[f"127.0.0.1:{self._upstream.server_port}"],
+                    protocol=TileServerProtocol.HTTP)])
+
+    def tearDown(self):
+        del root.mainConf["test_png"]
+        for server in (self._upstream, self._proxy):
+            server.shutdown()
+            server.server_close()
+        self._cacheDir.cleanup()
+
+    def _get(self, path: str, headers: Optional[dict] = None) -> http.client.HTTPResponse:
+        conn = http.client.HTTPConnection("127.0.0.1", self._proxy.server_port)
+        try:
+            conn.request("GET", path, headers=headers or {})
+            response = conn.getresponse()
+            response.read()
+            return response
+        finally:
+            conn.close()
+
+    def test_same_etag_from_download_memory_and_disk(self):
+        downloaded = self._get("/test_png/1/0/0").getheader("ETag")
+        fromMemory = self._get("/test_png/1/0/0").getheader("ETag")
+        self._downloader._memoryCache.clear()
+        fromDisk = self._get("/test_png/1/0/0").getheader("ETag")
+        self.assertEqual(downloaded, fromMemory)
+        self.assertEqual(downloaded, fromDisk)
+
+        response = self._get("/test_png/1/0/0", {"If-None-Match": fromDisk})
+        self.assertEqual(response.status, 304)
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import time
+import unittest
+
+from tilecache import DiskCacheEvictor, LRUBlobCache, markCacheFileUsed
+
+
+class TestLRUBlobCache(unittest.TestCase):
+    def test_get_put(self):
+        cache = LRUBlobCache()
+        self.assertIsNone(cache.get("tile"))
+        cache.put("tile", b"data", time.time() + 60)
+        self.assertEqual(cache.get("tile"), b"data")
+
+    def test_get_with_etag(self):
+        cache = LRUBlobCache()
+        cache.put("tile", b"data", time.time() + 60, '"1-4"')
+        cache.put("composite", b"data", time.time() + 60)
+        self.assertEqual(cache.getWithETag("tile"), (b"data", '"1-4"'))
+        self.assertEqual(cache.getWithETag("composite"), (b"data", None))
+
+    def test_expired_entries_are_dropped(self):
+        cache = LRUBlobCache()
+        cache.put("tile", b"data", time.time() - 1)
+        self.assertIsNone(cache.get("tile"))
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = LRUBlobCache(maxEntries=2)
+        expiresAt = time.time() + 60
+        cache.put("a", b"a", expiresAt)
+        cache.put("b", b"b", expiresAt)
+        cache.get("a")
+        cache.put("c", b"c", expiresAt)
+        self.assertEqual(cache.get("a"), b"a")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"c")
+
+    def test_evicts_by_size(self):
+        cache = LRUBlobCache(maxBytes=8)
+        expiresAt = time.time() + 60
+        cache.put("a", b"aaaa", expiresAt)
+        cache.put("b", b"bbbb", expiresAt)
+        cache.put("c", b"cccc", expiresAt)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), b"bbbb")
+        # Blobs larger than the cache are not cached at all
+        cache.put("d", b"d" * 9, expiresAt)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(cache.get("c"), b"cccc")
+
+
+class TestDiskCacheEvictor(unittest.TestCase):
+    def _writeFile(self, path: str, size: int, atime: float):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"x" * size)
+        os.utime(path, (atime, atime))
+
+    def test_evicts_least_recently_used_files(self):
+        with tempfile.TemporaryDirectory() as basePath:
+            now = time.time()
+            old = os.path.join(basePath, "map", "1", "0", "0")
+            recent = os.path.join(basePath, "map", "1", "0", "1")
+            tmp = os.path.join(basePath, "map", "1", "0", ".1.abc.tmp")
+            self._writeFile(old, 100, now - 100)
+            self._writeFile(recent, 100, now)
+            self._writeFile(tmp, 100, now - 200)
+
+            self.assertEqual(DiskCacheEvictor(basePath, 150).evict(), 100)
+            self.assertFalse(os.path.exists(old))
+            self.assertTrue(os.path.exists(recent))
+            self.assertTrue(os.path.exists(tmp))
+
+    def test_removes_stale_temporary_files(self):
+        with tempfile.TemporaryDirectory() as basePath:
+            now = time.time()
+            stale = os.path.join(basePath, "map", "1", "0", ".0.abc.tmp")
+            inProgress = os.path.join(basePath, "map", "1", "0", ".1.abc.tmp")
+            self._writeFile(stale, 100, now - 7200)
+            self._writeFile(inProgress, 100, now)
+
+            DiskCacheEvictor(basePath, 1000).evict()
+            self.assertFalse(os.path.exists(stale))
+            self.assertTrue(os.path.exists(inProgress))
+
+    def test_nothing_evicted_under_budget(self):
+        with tempfile.TemporaryDirectory() as basePath:
+            path = os.path.join(basePath, "map", "0")
+            self._writeFile(path, 100, time.time())
+            self.assertEqual(DiskCacheEvictor(basePath, 100).evict(), 0)
+            self.assertTrue(os.path.exists(path))
+
+    def test_read_files_are_marked_as_used(self):
+        with tempfile.TemporaryDirectory() as basePath:
+            now = time.time()
+            used = os.path.join(basePath, "map", "1", "0", "0")
+            unused = os.path.join(basePath, "map", "1", "0", "1")
+            # The used file was cached first, and its access time is not
+            # updated by the kernel (e.g. on a noatime mount)
+            self._writeFile(used, 100, now - 7200)
+            self._writeFile(unused, 100, now - 3600)
+            with open(used, "rb") as f:
+                st = os.fstat(f.fileno())
+                markCacheFileUsed(f.fileno(), st)
+
+            # The modification time is the time the file was cached, and
+            # must not change
+            self.assertEqual(os.stat(used).st_mtime_ns, st.st_mtime_ns)
+            self.assertEqual(DiskCacheEvictor(basePath, 150).evict(), 100)
+            self.assertTrue(os.path.exists(used))
+            self.assertFalse(os.path.exists(unused))